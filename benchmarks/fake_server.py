@@ -0,0 +1,143 @@
+'''
+    Paul Smith
+
+    A local HTTP server serving synthetic podcast feeds and audio files for
+    the benchmarks
+
+    /feed.xml?items=N&size=BYTES&latency=SECONDS&ranges=1&rate=BYTES
+        an rss feed with N items whose enclosures point at /audio/ using the
+        given size, latency, range support and throttling
+    /audio/<number>.mp3?size=BYTES&latency=SECONDS&ranges=1&rate=BYTES
+        a file of the given size, sent after the latency, with or without
+        support for Range requests, throttled to rate bytes per second
+
+'''
+
+import hashlib, threading, time
+from xml.sax.saxutils import quoteattr
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BLOCK = bytes(range(256)) * 256
+
+
+def synthetic_feed(base: str, items: int, query: str) -> bytes:
+    start = 1262304000
+    entries = []
+    for number in range(items, 0, -1):
+        entries.append(
+            f'<item><title>Episode {number}</title>'
+            f'<guid>{base}/episodes/{number}</guid>'
+            f'<pubDate>{formatdate(start + number * 86400, usegmt=True)}</pubDate>'
+            f'<description>Show notes for episode {number}. {"Lorem ipsum dolor sit amet. " * 20}</description>'
+            f'<enclosure url={quoteattr(f"{base}/audio/{number}.mp3?{query}")} type="audio/mpeg"/></item>')
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">'
+            '<channel><title>Benchmark Show</title><itunes:author>Benchmarks</itunes:author>'
+            f'<lastBuildDate>{formatdate(start + items * 86400, usegmt=True)}</lastBuildDate>'
+            + ''.join(entries) + '</channel></rss>').encode()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    feeds = {}
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _options(self, query: dict) -> tuple:
+        size = int(query.get('size', ['1048576'])[0])
+        latency = float(query.get('latency', ['0'])[0])
+        ranges = query.get('ranges', ['1'])[0] == '1'
+        rate = float(query.get('rate', ['0'])[0])
+        return size, latency, ranges, rate
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        size, latency, ranges, rate = self._options(query)
+        if latency:
+            time.sleep(latency)
+        if url.path == '/feed.xml':
+            self._feed(int(query.get('items', ['100'])[0]), url.query)
+        elif url.path.startswith('/audio/'):
+            self._audio(size, ranges, rate)
+        else:
+            self.send_error(404)
+
+    def _feed(self, items: int, query: str) -> None:
+        key = (items, query)
+        if key not in self.feeds:
+            base = f'http://{self.headers["Host"]}'
+            body = synthetic_feed(base, items, query)
+            self.feeds[key] = (body, '"' + hashlib.md5(body).hexdigest() + '"')
+        body, etag = self.feeds[key]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _audio(self, size: int, ranges: bool, rate: float) -> None:
+        start, end = 0, size - 1
+        requested = self.headers.get('Range')
+        if ranges and requested and requested.startswith('bytes='):
+            first, _, last = requested[6:].partition('-')
+            start = int(first)
+            end = int(last) if last else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        if ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', f'"{size}"')
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        remaining = end - start + 1
+        started = time.monotonic()
+        sent = 0
+        while remaining > 0:
+            # Byte n of every file is n % 256, so ranges line up with the
+            # bytes a full download would have returned
+            offset = (start + sent) % 256
+            chunk = BLOCK[offset:offset + min(len(BLOCK) - 256, remaining)]
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+            sent += len(chunk)
+            if rate:
+                # Sleep until the bytes sent match the throttled rate
+                delay = sent / rate - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def start_server(port: int=0) -> ThreadingHTTPServer:
+    '''
+        Start the fake podcast server in a background thread
+
+        returns: the server, its address is server.server_address
+
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    server = start_server(8000)
+    print(f'Serving on http://127.0.0.1:{server.server_address[1]}/feed.xml')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,45 @@
+'''
+    Paul Smith
+
+    Measures how long the app takes to import and which heavy modules are
+    loaded on startup
+
+    usage: python benchmarks/imports.py [--repeat N]
+
+'''
+
+import argparse, json, os, statistics, subprocess, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ('feedparser', 'requests', 'simple_term_menu', 'sqlite3')
+PROBE = ('import json, sys, time; start = time.perf_counter(); import {module}; '
+         'elapsed = time.perf_counter() - start; '
+         'print(json.dumps([elapsed, [name for name in {heavy!r} if name in sys.modules]]))')
+
+
+def measure(module: str='main', repeat: int=5) -> dict:
+    samples, loaded = [], []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)],
+                                cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        elapsed, loaded = json.loads(output)
+        samples.append(elapsed)
+    return {
+        'module': module,
+        'runs': repeat,
+        'median_seconds': statistics.median(samples),
+        'min_seconds': min(samples),
+        'heavy_modules_loaded': loaded,
+    }
+
+def main(argv: list=None) -> list:
+    parser = argparse.ArgumentParser(description='Measure startup import time')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each import')
+    args = parser.parse_args(argv)
+    results = [measure(module, args.repeat) for module in ('main', 'cli', 'manifest')]
+    print(json.dumps(results, indent=4))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''
+    Paul Smith
+
+    Compares the memory used by a synthetic manifest of Episode objects
+    against the original dict based Episode layout
+
+    usage: python benchmarks/memory.py [episodes]
+
+'''
+
+import gc, json, os, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from episode import Episode
+
+
+class LegacyEpisode:
+    # The attribute layout Episode had before it used __slots__
+    def __init__(self, title, folder, url, episode_number, published, summary, tags):
+        self.title = title
+        self.file_path = folder + title.lower().replace(' ', '') + '.mp3'
+        self.url = url
+        self.downloaded = False
+        self.episode_number = episode_number
+        self.published = tuple(published)
+        self.summary = summary
+        self.last_updated = time.localtime()
+        self.tags = tags
+
+
+def synthetic_records(count: int) -> list:
+    start = 1262304000
+    return [{
+        'title': f'Episode {number}: A synthetic title for benchmarking',
+        'url': f'https://cdn.example.com/show/episode-{number}.mp3',
+        'published': list(time.gmtime(start + number * 86400)),
+        'summary': None,
+        'tags': ['news', 'technology'],
+        'guid': f'https://example.com/show/{number}',
+    } for number in range(count)]
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    objects = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return current
+
+def main(count: int=50000) -> dict:
+    records = synthetic_records(count)
+    folder = '/tmp/benchmark/'
+    legacy = measure(lambda: [
+        LegacyEpisode(record['title'], folder, record['url'], number, record['published'],
+                      record['summary'], list(record['tags']))
+        for number, record in enumerate(records)])
+    current = measure(lambda: [
+        Episode(record['title'], folder, record['url'], number, record['published'],
+                record['summary'], record['tags'], record['guid'])
+        for number, record in enumerate(records)])
+    return {
+        'episodes': count,
+        'legacy_bytes': legacy,
+        'current_bytes': current,
+        'legacy_bytes_per_episode': round(legacy / count),
+        'current_bytes_per_episode': round(current / count),
+        'reduction': round(1 - current / legacy, 3),
+    }
+
+
+if __name__ == '__main__':
+    print(json.dumps(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000), indent=4))
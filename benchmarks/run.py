@@ -0,0 +1,118 @@
+'''
+    Paul Smith
+
+    Times feed fetching, manifest serialization and downloads end to end
+    against the fake podcast server, printing the results as json
+
+    usage: python benchmarks/run.py [--items N] [--downloads N] [--output FILE]
+
+'''
+
+import argparse, json, os, resource, shutil, statistics, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_server import start_server
+from imports import measure as measure_imports
+from manifest import Manifest
+
+
+def summarize(samples: list) -> dict:
+    ordered = sorted(samples)
+
+    def percentile(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {
+        'runs': len(samples),
+        'mean': statistics.fmean(samples),
+        'min': ordered[0],
+        'p50': percentile(0.5),
+        'p90': percentile(0.9),
+        'p99': percentile(0.99),
+        'max': ordered[-1],
+    }
+
+def timed(function, repeat: int) -> tuple:
+    samples, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - start)
+    return result, summarize(samples)
+
+def peak_rss() -> int:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+def main(argv: list=None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', type=int, default=2000, help='items in the synthetic feed')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each timed operation')
+    parser.add_argument('--downloads', type=int, default=20, help='episodes to download')
+    parser.add_argument('--size', type=int, default=1048576, help='bytes per audio file')
+    parser.add_argument('--latency', type=float, default=0, help='server latency in seconds')
+    parser.add_argument('--rate', type=float, default=0, help='throttle per connection, bytes/s')
+    parser.add_argument('--no-ranges', action='store_true', help='disable Range support')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent downloads')
+    parser.add_argument('--stream', action='store_true', help='use the streaming feed parser')
+    parser.add_argument('--output', help='write the json results to a file')
+    args = parser.parse_args(argv)
+
+    server = start_server()
+    query = (f'items={args.items}&size={args.size}&latency={args.latency}'
+             f'&ranges={0 if args.no_ranges else 1}&rate={args.rate}')
+    url = f'http://127.0.0.1:{server.server_address[1]}/feed.xml?{query}'
+    Manifest.streaming = args.stream
+    Manifest.save_interval = 0
+
+    # Manifests create their folder as ../<title>/, so work one level down
+    root = tempfile.mkdtemp(prefix='rss-benchmark-')
+    os.makedirs(os.path.join(root, 'app'))
+    cwd = os.getcwd()
+    os.chdir(os.path.join(root, 'app'))
+    results = {'items': args.items, 'streaming': args.stream, 'operations': {}}
+    operations = results['operations']
+    try:
+        manifest, operations['from_url'] = timed(lambda: Manifest.from_url(url, 0), args.repeat)
+        os.makedirs(manifest.folder, exist_ok=True)
+        manifest.save()
+
+        _, operations['update_not_modified'] = timed(
+            lambda: manifest.update(verbosity=0, interactive=False), args.repeat)
+        _, operations['update_forced'] = timed(
+            lambda: manifest.update(forced=True, verbosity=0, interactive=False), args.repeat)
+        _, operations['save_to_json'] = timed(manifest.save_to_json, args.repeat)
+        _, operations['from_json'] = timed(lambda: Manifest.from_json(manifest.folder), args.repeat)
+
+        episodes = manifest.episodes[-args.downloads:]
+        start = time.perf_counter()
+        failures = manifest.download_episodes(0, True, episodes, workers=args.workers,
+                                              interactive=False)
+        elapsed = time.perf_counter() - start
+        downloaded = sum(os.path.getsize(episode.file_path) for episode in episodes
+                         if os.path.exists(episode.file_path))
+        operations['download_episodes'] = {
+            'episodes': len(episodes),
+            'failures': len(failures),
+            'workers': args.workers,
+            'seconds': elapsed,
+            'bytes': downloaded,
+            'throughput_bytes_per_second': downloaded / elapsed if elapsed else None,
+        }
+        results['peak_rss_bytes'] = peak_rss()
+        results['imports'] = measure_imports('main', args.repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+        server.shutdown()
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as report:
+            report.write(output)
+    print(output)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+'''
+    Paul Smith
+
+    A paged terminal browser for the episodes of a manifest, with filters
+    by download state and date range and a live text search, built once
+    per manifest so flipping pages of large feeds stays instant
+
+'''
+
+import bisect, calendar, time
+from fancy_print import fprint, clear, pause
+
+PAGE_SIZE = 25
+
+NEXT_PAGE = "[.] Next page"
+PREVIOUS_PAGE = "[,] Previous page"
+GO_TO_PAGE = "[g] Go to page"
+SEARCH = "[s] Search titles"
+FILTER = "[f] Filter"
+BACK = "[q] Back"
+
+
+def parse_date(text: str, end: bool=False):
+    '''
+        Parse a YYYY-MM-DD date, end=True gives the last second of the day
+
+        returns: int seconds since the epoch (UTC), or None for empty text
+
+    '''
+    text = text.strip()
+    if not text:
+        return None
+    seconds = calendar.timegm(time.strptime(text, '%Y-%m-%d'))
+    return seconds + 86399 if end else seconds
+
+
+class EpisodeFilter:
+    """
+    A class describing which episodes the browser shows
+
+    ...
+
+    Attributes
+    ----------
+    downloaded : bool
+        True for downloaded episodes only, False for episodes not
+        downloaded, None for both
+    since : int
+        the earliest publishing date shown, or None
+    until : int
+        the latest publishing date shown, or None
+
+    Methods
+    -------
+    matches(episode: Episode)
+        returns whether the episode passes the filter
+    narrows(other: EpisodeFilter)
+        returns whether every episode matching this filter matches other
+    """
+
+    def __init__(self, downloaded: bool=None, since: int=None, until: int=None):
+        self.downloaded = downloaded
+        self.since = since
+        self.until = until
+
+    def __str__(self) -> str:
+        parts = []
+        if self.downloaded is not None:
+            parts.append('downloaded' if self.downloaded else 'not downloaded')
+        if self.since is not None or self.until is not None:
+            since = '' if self.since is None else time.strftime('%Y-%m-%d', time.gmtime(self.since))
+            until = '' if self.until is None else time.strftime('%Y-%m-%d', time.gmtime(self.until))
+            parts.append(f'{since}..{until}')
+        return ', '.join(parts)
+
+    def matches(self, episode) -> bool:
+        if self.downloaded is not None and episode.downloaded != self.downloaded:
+            return False
+        if self.since is not None and episode.published < self.since:
+            return False
+        if self.until is not None and episode.published > self.until:
+            return False
+        return True
+
+    def narrows(self, other) -> bool:
+        # A stricter filter only removes matches, so the new matches can be
+        # found among the old ones instead of the whole manifest
+        return (other.downloaded in (None, self.downloaded)
+                and (other.since is None or (self.since is not None and self.since >= other.since))
+                and (other.until is None or (self.until is not None and self.until <= other.until)))
+
+
+class EpisodeBrowser:
+    """
+    A class to page through and view the episodes of a manifest
+
+    ...
+
+    Attributes
+    ----------
+    manifest : Manifest
+        the manifest being browsed
+    page_size : int
+        the number of episodes on a page
+    filter : EpisodeFilter
+        the filter applied to the episodes
+    visible : list
+        the indices in manifest.episodes of the episodes passing the filter
+    viewed : dict
+        the episodes viewed so far, saved together when the browser closes
+
+    Methods
+    -------
+    set_filter(episode_filter: EpisodeFilter)
+        shows only the episodes matching the filter
+    page_count()
+        returns the number of pages of visible episodes
+    search()
+        returns the index of an episode picked from a menu of every visible
+        episode that narrows as the user types, or None
+    run()
+        shows the browser until the user goes back, then saves the viewed
+        episodes
+    """
+
+    def __init__(self, manifest, page_size: int=PAGE_SIZE):
+        self.manifest = manifest
+        self.page_size = page_size
+        self.filter = EpisodeFilter()
+        self.visible = list(range(len(manifest.episodes)))
+        self.viewed = {}
+        self.page = 1
+        # Labels are built once, later only those of viewed episodes are
+        # rebuilt
+        self._labels = [self._label(episode) for episode in manifest.episodes]
+        # Menus of pages already shown, and the search menu under None,
+        # dropped when the filter changes
+        self._menus = {}
+
+    @staticmethod
+    def _label(episode) -> str:
+        date = time.strftime('%Y-%m-%d', time.gmtime(episode.published))
+        mark = '*' if episode.downloaded else ' '
+        return f'{date} {mark} {episode.title}'
+
+    def set_filter(self, episode_filter: EpisodeFilter) -> None:
+        if episode_filter.narrows(self.filter):
+            candidates = self.visible
+        else:
+            candidates = range(len(self.manifest.episodes))
+        episodes = self.manifest.episodes
+        self.visible = [number for number in candidates if episode_filter.matches(episodes[number])]
+        self.filter = episode_filter
+        self.page = 1
+        self._menus.clear()
+
+    def page_count(self) -> int:
+        return max(1, -(-len(self.visible) // self.page_size))
+
+    def _page(self, page: int) -> tuple:
+        # The menu entries of a page and what each of them does
+        start = (page - 1) * self.page_size
+        numbers = self.visible[start:start + self.page_size]
+        entries = [self._labels[number] for number in numbers]
+        actions = list(numbers)
+        if page > 1:
+            entries.insert(0, PREVIOUS_PAGE)
+            actions.insert(0, PREVIOUS_PAGE)
+        for command in (NEXT_PAGE if page < self.page_count() else None, GO_TO_PAGE, SEARCH, FILTER, BACK):
+            if command is not None:
+                entries.append(command)
+                actions.append(command)
+        return entries, actions
+
+    def _menu(self, page: int) -> tuple:
+        from simple_term_menu import TerminalMenu
+        if page not in self._menus:
+            entries, actions = self._page(page)
+            self._menus[page] = (TerminalMenu(entries), actions)
+        return self._menus[page]
+
+    def search(self):
+        from simple_term_menu import TerminalMenu
+        if None not in self._menus:
+            # Typing filters the cached labels of the whole filtered list,
+            # not just the current page
+            labels = [self._labels[number] for number in self.visible]
+            menu = TerminalMenu(labels, title=f'{self.manifest.title}: type to search, Enter to view',
+                                search_key=None, show_search_hint=True)
+            self._menus[None] = (menu, list(self.visible))
+        menu, numbers = self._menus[None]
+        clear()
+        choice = menu.show()
+        return None if choice is None else numbers[choice]
+
+    def _ask_page(self) -> None:
+        answer = input(f'Page (1-{self.page_count()}): ').strip()
+        if answer.isnumeric():
+            self.page = min(max(1, int(answer)), self.page_count())
+
+    def _ask_filter(self) -> None:
+        from simple_term_menu import TerminalMenu
+        states = ["[a] All episodes", "[d] Downloaded", "[n] Not downloaded"]
+        clear()
+        fprint(f'Filter {self.manifest.title}', 'gt')
+        choice = TerminalMenu(states).show()
+        if choice is None:
+            return
+        downloaded = (None, True, False)[choice]
+        try:
+            since = parse_date(input('Published from (YYYY-MM-DD, blank for any): '))
+            until = parse_date(input('Published until (YYYY-MM-DD, blank for any): '), end=True)
+        except ValueError:
+            fprint('Dates look like 2023-01-31', 'rt')
+            pause()
+            return
+        self.set_filter(EpisodeFilter(downloaded, since, until))
+
+    def _view(self, number: int) -> bool:
+        episode = self.manifest.episodes[number]
+        # Recorded first so a failed download still saves the view
+        self.viewed[number] = episode
+        viewing = episode.view()
+        label = self._label(episode)
+        if label != self._labels[number]:
+            # Downloaded from the detail view, rebuild the menus showing it
+            self._labels[number] = label
+            # visible keeps manifest order, so the episode's page is found
+            # by bisection, it may not be the page the user is on when the
+            # episode was picked from the search menu
+            position = bisect.bisect_left(self.visible, number)
+            self._menus.pop(position // self.page_size + 1, None)
+            self._menus.pop(None, None)
+        return viewing
+
+    def run(self) -> None:
+        try:
+            viewing = True
+            while viewing:
+                menu, actions = self._menu(self.page)
+                clear()
+                heading = f'{self.manifest.title}: {self.page}/{self.page_count()}'
+                if str(self.filter):
+                    heading += f' ({len(self.visible)} matching {self.filter})'
+                fprint(heading, 'gt')
+                choice = menu.show()
+                action = BACK if choice is None else actions[choice]
+                if action == NEXT_PAGE:
+                    self.page += 1
+                elif action == PREVIOUS_PAGE:
+                    self.page -= 1
+                elif action == GO_TO_PAGE:
+                    self._ask_page()
+                elif action == SEARCH:
+                    number = self.search()
+                    if number is not None:
+                        viewing = self._view(number)
+                elif action == FILTER:
+                    self._ask_filter()
+                elif action == BACK:
+                    viewing = False
+                else:
+                    viewing = self._view(action)
+        finally:
+            # Persist once on the way out rather than after every episode,
+            # also when a download from the detail view raised
+            if self.viewed:
+                self.manifest.save_episodes(list(self.viewed.values()))
+            self.manifest.flush()
+        clear()
@@ -0,0 +1,270 @@
+'''
+    Paul Smith
+
+    A non-interactive command line interface for syncing feeds from cron or
+    systemd, without any menus or pauses
+
+'''
+
+import argparse, os, time
+import metrics
+from fancy_print import fprint, format_size
+from manifest import Manifest
+from file_utils import configure_session, configure_downloads
+from integrity import get_index
+from scheduling import DownloadPolicy, parse_rate, parse_window
+from library import (FEED_MANIFEST, read_feeds, find_feed, load_manifest, refresh_all, sync_feed,
+                     download_all, migrate, search, latest, download_new)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Download podcasts from rss feeds')
+    parser.add_argument('--feeds', default=FEED_MANIFEST,
+                        help='path to the feed manifest (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of concurrent downloads or feed fetches')
+    parser.add_argument('--per-host', type=int, default=2,
+                        help='number of concurrent connections against one host, segments included')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='parse feeds in this many worker processes when refreshing all feeds')
+    parser.add_argument('--pool-size', type=int, default=10,
+                        help='number of keep-alive connections kept per host')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for a server before retrying')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='number of retries with exponential backoff')
+    parser.add_argument('--chunk-size', type=lambda size: int(parse_rate(size)),
+                        help='bytes read from the network at a time, e.g. 256K')
+    parser.add_argument('--segments', type=int,
+                        help='connections used for each large episode when the host allows ranges')
+    parser.add_argument('--segment-threshold', type=lambda size: int(parse_rate(size)),
+                        help='smallest file downloaded in segments, e.g. 100M (default: 100M)')
+    parser.add_argument('--rate', type=parse_rate,
+                        help='total download rate limit, e.g. 2M for 2 MB/s')
+    parser.add_argument('--feed-rate', type=parse_rate,
+                        help='download rate limit for each feed')
+    parser.add_argument('--window', action='append', type=parse_window, default=[],
+                        help='time window like 22:00-06:00 in which back-catalog '
+                             'episodes may be downloaded, may be repeated')
+    parser.add_argument('--stream', action='store_true',
+                        help='parse feeds incrementally, stopping at known episodes')
+    parser.add_argument('--compact', action='store_true',
+                        help='write json manifests without indentation')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write a json timing report at the end of the run, - for stdout')
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help='write the timings as a Prometheus textfile for the node exporter')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sync = commands.add_parser('sync', help='update feeds and download missing episodes')
+    sync.add_argument('feed', nargs='*', help='feed titles or numbers (default: all)')
+
+    update = commands.add_parser('update', help='update the manifest of feeds')
+    update.add_argument('feed', nargs='*', help='feed titles or numbers (default: all)')
+
+    download = commands.add_parser('download', help='download missing episodes')
+    download.add_argument('feed', nargs='*', help='feed titles or numbers (default: all)')
+
+    listing = commands.add_parser('list', help='list feeds, or the episodes of a feed')
+    listing.add_argument('feed', nargs='?', help='feed title or number')
+
+    verify = commands.add_parser('verify', help='check downloaded files against the library index')
+    verify.add_argument('--hash', action='store_true', help='compare sha256 hashes, not only sizes')
+    verify.add_argument('--fix', action='store_true',
+                        help='delete bad files so the next download fetches them again')
+
+    timeline = commands.add_parser('latest', help='list the newest episodes across every feed')
+    timeline.add_argument('--limit', type=int, default=20,
+                          help='most episodes shown (default: %(default)s)')
+    timeline.add_argument('--since', type=float, metavar='DAYS',
+                          help='only episodes published in the last DAYS days')
+    timeline.add_argument('--update', action='store_true',
+                          help='update every feed first')
+    timeline.add_argument('--download', action='store_true',
+                          help='download everything published since the last --download run')
+
+    commands.add_parser('usage', help='show the disk space used by each feed')
+
+    prune = commands.add_parser('prune', help='delete downloads to meet retention limits')
+    prune.add_argument('--keep-last', type=int, metavar='N',
+                       help='keep only the N newest downloads of each feed')
+    prune.add_argument('--max-feed-size', type=lambda size: int(parse_rate(size)), metavar='SIZE',
+                       help='most space used by each feed, e.g. 5G')
+    prune.add_argument('--max-age', type=float, metavar='DAYS',
+                       help='delete downloads of episodes published more than DAYS days ago')
+    prune.add_argument('--max-total', type=lambda size: int(parse_rate(size)), metavar='SIZE',
+                       help='most space used by the whole library, e.g. 200G')
+    prune.add_argument('--lru', action='store_true',
+                       help='meet size limits by deleting the least recently viewed first')
+    prune.add_argument('--dry-run', action='store_true', help='only list what would be deleted')
+
+    searching = commands.add_parser('search', help='search episode titles, summaries and tags')
+    searching.add_argument('query', nargs='+', help='words to look for')
+    searching.add_argument('--limit', type=int, default=20,
+                           help='most results shown (default: %(default)s)')
+    searching.add_argument('--rebuild', action='store_true',
+                           help='re-index every feed before searching')
+
+    commands.add_parser('migrate', help='move the json manifests into a SQLite store')
+
+    daemon = commands.add_parser('daemon', help='keep polling feeds until stopped')
+    daemon.add_argument('--interval', type=float, default=3600,
+                        help='seconds between polls of each feed (default: %(default)s)')
+    daemon.add_argument('--jitter', type=float, default=0.1,
+                        help='random fraction added to each interval (default: %(default)s)')
+    return parser
+
+def _select_feeds(names: list, path: str) -> list:
+    if not names:
+        return read_feeds(path)
+    feeds = []
+    for name in names:
+        feed = find_feed(name, path)
+        if feed is None:
+            raise SystemExit(f'Unknown feed: {name}')
+        feeds.append(feed)
+    return feeds
+
+def _write_metrics(args: argparse.Namespace) -> None:
+    if args.metrics:
+        metrics.write_report(args.metrics)
+    if args.prometheus:
+        metrics.write_prometheus(args.prometheus)
+
+def main(argv: list=None) -> int:
+    args = build_parser().parse_args(argv)
+    Manifest.compact = args.compact
+    Manifest.streaming = args.stream
+    # Enough kept alive connections for every worker or segment on one host
+    configure_session(max(args.pool_size, args.workers, args.per_host, args.segments or 1),
+                      args.timeout, args.retries)
+    configure_downloads(args.chunk_size, segments=args.segments,
+                        segment_threshold=args.segment_threshold)
+    policy = DownloadPolicy(args.rate, args.feed_rate, args.window)
+    try:
+        return _run(args, policy)
+    finally:
+        _write_metrics(args)
+
+def _run(args: argparse.Namespace, policy: DownloadPolicy) -> int:
+    failed = False
+
+    if args.command == 'list':
+        if args.feed is None:
+            for number, feed in enumerate(read_feeds(args.feeds)):
+                print(f'{number}: {feed["title"]}')
+            return 0
+        feed = find_feed(args.feed, args.feeds)
+        if feed is None:
+            raise SystemExit(f'Unknown feed: {args.feed}')
+        manifest = load_manifest(feed, verbosity=0)
+        if manifest is None:
+            raise SystemExit(f'Invalid feed URL: {feed["url"]}')
+        for episode in manifest.episodes:
+            mark = '*' if episode.downloaded else ' '
+            print(f'{episode.episode_number} {mark} {time.strftime("%Y-%m-%d", time.gmtime(episode.published))} {episode.title}')
+        return 0
+
+    if args.command == 'verify':
+        index = get_index()
+        problems = index.verify(args.hash, args.workers)
+        for path, problem in problems:
+            fprint(f'{path}: {problem}', 'r')
+            if args.fix:
+                if os.path.exists(path):
+                    os.remove(path)
+                index.remove(path)
+        fprint(f'{len(index.files)} files checked, {len(problems)} problems', 'g')
+        return 1 if problems else 0
+
+    if args.command == 'latest':
+        if args.update:
+            results = refresh_all(args.workers, path=args.feeds, processes=args.processes)
+            failed = any(error is not None for _, _, error in results)
+        since = None if args.since is None else int(time.time() - args.since * 86400)
+        if args.download:
+            episodes, failures = download_new(args.workers, args.per_host, policy=policy,
+                                              since=since, path=args.feeds)
+            fprint(f'{len(episodes) - len(failures)} new episodes downloaded, {len(failures)} failed', 'g')
+            return 1 if failed or failures else 0
+        for entry in latest(args.limit, since, args.feeds):
+            mark = '*' if entry['downloaded'] else ' '
+            print(f'{time.strftime("%Y-%m-%d", time.gmtime(entry["published"]))} {mark} '
+                  f'{entry["feed"]}: {entry["title"]}')
+        return 1 if failed else 0
+
+    if args.command == 'usage':
+        from retention import usage
+        index = get_index()
+        for feed, used in usage(args.feeds):
+            print(f'{format_size(used):>12} {feed["title"]}')
+        print(f'{format_size(index.usage()):>12} total, {format_size(index.disk_usage())} on disk')
+        return 0
+
+    if args.command == 'prune':
+        from retention import RetentionPolicy, plan, evict
+        policy = RetentionPolicy(args.keep_last, args.max_feed_size,
+                                 None if args.max_age is None else args.max_age * 86400,
+                                 args.max_total, args.lru)
+        selected = plan(policy, args.feeds)
+        for manifest, episode, size in selected:
+            print(f'{format_size(size):>12} {manifest.title}: {episode.title}')
+        if args.dry_run:
+            fprint(f'{len(selected)} downloads, {format_size(sum(size for _, _, size in selected))} would be freed', 'g')
+        else:
+            fprint(f'{len(selected)} downloads deleted, {format_size(evict(selected))} freed', 'g')
+        return 0
+
+    if args.command == 'search':
+        if args.rebuild:
+            from search import get_search_index
+            get_search_index().rebuild(read_feeds(args.feeds), lambda feed: load_manifest(feed, verbosity=0))
+        for result in search(' '.join(args.query), args.limit, args.feeds):
+            print(result)
+            if result.snippet:
+                print('    ' + result.snippet)
+        return 0
+
+    if args.command == 'migrate':
+        fprint(f'Imported {migrate(args.feeds)} manifests', 'g')
+        return 0
+
+    if args.command == 'daemon':
+        # Imported here so the signal handling is only set up for the daemon
+        from daemon import Daemon
+        # Reports are refreshed after every poll rather than only at exit
+        Daemon(args.interval, args.jitter, workers=args.workers, per_host=args.per_host,
+               path=args.feeds, policy=policy, on_poll=lambda: _write_metrics(args)).run()
+        return 0
+
+    if args.command in ('update', 'sync') and not args.feed:
+        results = refresh_all(args.workers, path=args.feeds, processes=args.processes)
+        failed = any(error is not None for _, _, error in results)
+        if args.command == 'update':
+            return 1 if failed else 0
+
+    if args.command in ('download', 'sync') and not args.feed:
+        # One pool across every feed so the newest episodes come first
+        failures = download_all(read_feeds(args.feeds), args.workers, args.per_host, policy=policy)
+        return 1 if failed or failures else 0
+
+    for feed in _select_feeds(args.feed, args.feeds):
+        fprint(feed['title'], 'bt')
+        try:
+            if args.command == 'sync':
+                _, _, failures = sync_feed(feed, args.workers, args.per_host, 1, policy)
+                failed = failed or bool(failures)
+                continue
+            manifest = load_manifest(feed)
+            if manifest is None:
+                failed = True
+            elif args.command == 'update':
+                manifest.update(interactive=False)
+            elif args.command == 'download':
+                failures = manifest.download_episodes(workers=args.workers, per_host=args.per_host,
+                                                      interactive=False, policy=policy)
+                failed = failed or bool(failures)
+        except Exception as error:
+            fprint(str(error), 'rt')
+            failed = True
+    return 1 if failed else 0
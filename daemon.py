@@ -0,0 +1,112 @@
+'''
+    Paul Smith
+
+    A long running poller that keeps every saved feed synced on its own
+    schedule, for running under cron or systemd
+
+'''
+
+import heapq, random, signal, threading, time
+from fancy_print import fprint
+from library import FEED_MANIFEST, read_feeds, sync_feed
+
+
+class Daemon:
+    """
+    A class to poll every saved feed and download new episodes
+
+    ...
+
+    Attributes
+    ----------
+    interval : float
+        the default number of seconds between polls of a feed, a feed entry
+        in the feed manifest may override it with an 'interval' key
+    jitter : float
+        the fraction of the interval randomly added or removed from each
+        poll so feeds on the same host do not line up
+    max_backoff : float
+        the longest delay in seconds between polls of a failing feed
+    workers : int
+        the number of concurrent downloads for each feed
+    per_host : int
+        the number of concurrent downloads against a single host
+    policy : DownloadPolicy
+        the rate limits and time windows applied to downloads
+    on_poll : callable
+        called with no arguments after every poll, used to refresh the
+        metrics report
+
+    Methods
+    -------
+    run()
+        polls feeds until stop() is called or a SIGINT/SIGTERM is received
+    stop()
+        asks the daemon to exit after the current poll
+    """
+
+    def __init__(self, interval: float=3600, jitter: float=0.1, max_backoff: float=86400,
+                 workers: int=4, per_host: int=2, path: str=FEED_MANIFEST, policy=None, on_poll=None):
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.workers = workers
+        self.per_host = per_host
+        self.path = path
+        self.policy = policy
+        self.on_poll = on_poll
+        self._stopping = threading.Event()
+        self._failures = {}
+
+    def stop(self, *args) -> None:
+        self._stopping.set()
+
+    def _delay(self, feed: dict) -> float:
+        interval = float(feed.get('interval', self.interval))
+        failures = self._failures.get(feed['url'], 0)
+        if failures:
+            # Exponential backoff for feeds that keep failing
+            interval = min(interval * 2 ** failures, self.max_backoff)
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _poll(self, feed: dict) -> None:
+        try:
+            # The stop event ends waits for the download window on shutdown
+            feed, new_episodes, failures = sync_feed(feed, self.workers, self.per_host,
+                                                     policy=self.policy, stop=self._stopping)
+        except Exception as error:
+            self._failures[feed['url']] = self._failures.get(feed['url'], 0) + 1
+            fprint(f'{time.asctime()} {feed["title"]}: {error}', 'r')
+            return
+        self._failures.pop(feed['url'], None)
+        if new_episodes or failures:
+            fprint(f'{time.asctime()} {feed["title"]}: {len(new_episodes)} new, '
+                   f'{len(failures)} failed downloads', 'g')
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        # Spread the first poll of each feed over the jitter window
+        schedule = []
+        for feed in read_feeds(self.path):
+            start = time.monotonic() + random.uniform(0, self.jitter * float(feed.get('interval', self.interval)))
+            heapq.heappush(schedule, (start, feed['url']))
+
+        while schedule and not self._stopping.is_set():
+            due, url = heapq.heappop(schedule)
+            if self._stopping.wait(max(0, due - time.monotonic())):
+                break
+            # Re-read the feed list so added or removed feeds are picked up
+            feeds = {feed['url']: feed for feed in read_feeds(self.path)}
+            for feed_url, feed in feeds.items():
+                if feed_url != url and all(feed_url != queued for _, queued in schedule):
+                    heapq.heappush(schedule, (time.monotonic(), feed_url))
+            feed = feeds.get(url)
+            if feed is None:
+                continue
+            self._poll(feed)
+            if self.on_poll is not None:
+                self.on_poll()
+            heapq.heappush(schedule, (time.monotonic() + self._delay(feed), url))
+        fprint('Stopping...', 'g')
@@ -0,0 +1,138 @@
+'''
+    Paul Smith
+
+    A bounded worker pool for downloading many episodes at once, limiting both
+    the total number of connections and the connections made to a single host
+
+'''
+
+import os, queue, threading
+from urllib.parse import urlparse
+from fancy_print import fprint, MultiProgress
+from scheduling import DownloadPolicy
+from integrity import get_index
+
+
+class DownloadPool:
+    """
+    A class to download a batch of episodes concurrently
+
+    ...
+
+    Attributes
+    ----------
+    workers : int
+        the maximum number of downloads running at once
+    per_host : int
+        the maximum number of downloads running at once against a single host
+    policy : DownloadPolicy
+        the rate limits and time windows applied to downloads
+    stop : threading.Event
+        when set, downloads not yet started are dropped, or None
+    failures : list
+        a list of (episode, exception) tuples for downloads that failed
+
+    Methods
+    -------
+    run(episodes: list, force: bool=False, verbosity: int=1)
+        downloads every episode in the list, returning the failures
+    """
+
+    def __init__(self, workers: int=4, per_host: int=2, policy: DownloadPolicy=None,
+                 stop: threading.Event=None):
+        self.workers = max(1, workers)
+        self.per_host = max(1, per_host)
+        self.policy = policy if policy is not None else DownloadPolicy()
+        self.stop = stop
+        self.failures = []
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host_limit(self, url: str) -> threading.Semaphore:
+        host = urlparse(url or '').netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.Semaphore(self.per_host)
+            return self._hosts[host]
+
+    def _download(self, episode, force: bool, progress) -> None:
+        host_slots = self._host_limit(episode.url)
+        with host_slots:
+            if progress is not None:
+                progress.start(episode, episode.title)
+            try:
+                callback = None
+                if progress is not None:
+                    callback = lambda remaining, size: progress.update(episode, remaining, size)
+                throttle = self.policy.throttle(os.path.dirname(episode.file_path))
+                # Segments of large files count against the host limit too
+                episode.download(verbosity=0, force=force, callback=callback, throttle=throttle,
+                                 host_slots=host_slots)
+            except Exception as error:
+                with self._lock:
+                    self.failures.append((episode, error))
+                if progress is not None:
+                    progress.finish(episode, failed=True)
+            else:
+                if progress is not None:
+                    progress.finish(episode)
+
+    def run(self, episodes: list, force: bool=False, verbosity: int=1) -> list:
+        """Downloads a list of episodes using the worker pool
+
+        Parameters
+        ----------
+        episodes : list
+            The Episode objects to download
+        force : bool, optional
+            Whether files already present should be downloaded again
+            (default is False)
+        verbosity : int, optional
+            The logging level for the function (default is 1)
+            0: no logging
+            1: multi-line progress display and summary
+
+        Returns
+        -------
+        list
+            (episode, exception) tuples for every download that failed
+        """
+
+        self.failures = []
+        pending = [episode for episode in episodes if force or not episode.downloaded]
+        if not pending:
+            return self.failures
+        progress = MultiProgress(len(pending)) if verbosity > 0 else None
+        
+        # Workers take the newest episode of each feed first, back-catalog
+        # episodes wait for the policy's download window
+        jobs = queue.PriorityQueue()
+        for number, (priority, episode) in enumerate(self.policy.order(pending)):
+            jobs.put((priority, number, episode))
+        waiting = threading.Event()
+        
+        def work():
+            while self.stop is None or not self.stop.is_set():
+                try:
+                    priority, _, episode = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                if priority > 0 and not self.policy.in_window():
+                    if verbosity > 0 and not waiting.is_set():
+                        waiting.set()
+                        fprint('Waiting for the download window...', 'gt')
+                    if not self.policy.wait_for_window(self.stop):
+                        return
+                self._download(episode, force, progress)
+        
+        threads = [threading.Thread(target=work, daemon=True)
+                   for _ in range(min(self.workers, len(pending)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # One write of the library index for the whole batch
+        get_index().flush()
+        if progress is not None:
+            fprint(progress.summary(), 'gt')
+        return self.failures
@@ -6,10 +6,52 @@
 '''
 
 
-import os, time
+import os, sys, time, calendar, hashlib
+import metrics
 from file_utils import clean_path, download_file
+from integrity import get_index
 from fancy_print import fprint, pause, clear, download_progress
-from simple_term_menu import TerminalMenu
+
+_EMPTY_TAGS = ()
+_now = 0
+
+
+def to_epoch(value) -> int:
+    """Converts a time tuple, struct_time or epoch to an int epoch (UTC)"""
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    return calendar.timegm(tuple(value))
+
+def timestamp() -> int:
+    """Returns the current epoch, reusing the same int within a second"""
+    global _now
+    now = int(time.time())
+    if now != _now:
+        _now = now
+    return _now
+
+def intern_tags(tags) -> tuple:
+    if not tags:
+        return _EMPTY_TAGS
+    return tuple(sys.intern(str(tag)) for tag in tags)
+
+def audio_url(entry):
+    """Returns the href of the last audio enclosure of an entry, or None"""
+    url = None
+    for link in entry.links:
+        if 'audio' in link['type']:
+            url = link['href']
+    return url
+
+def entry_hash(entry) -> str:
+    """Returns a short digest of the fields of an entry saved in an Episode,
+    used to skip entries that have not changed since the last update"""
+    content = '\0'.join((entry.title or '', entry.get('id') or '', audio_url(entry) or '',
+                         entry.summary or '', str(to_epoch(entry.published_parsed))))
+    return hashlib.blake2b(content.encode(), digest_size=8).hexdigest()
+
 
 class Episode:
     """
@@ -27,23 +69,43 @@ class Episode:
         the url for the hosted file
     downloaded : bool
         whether the file is present on the drive at the file_path
-    published : tuple
-        the publishing date of the episode in tuple format
+    published : int
+        the publishing date of the episode in seconds since the epoch (UTC)
     summary : str
-        the description of the item from the rss feed
-    last_updated : tuple
-        the last time the episode object was updated
-    tags : list
-        a list of tags for the episode
+        the description of the item from the rss feed, loaded on first use
+        through summary_loader when the episode came from a manifest index
+    summary_loader : callable
+        a function taking the episode and returning its summary, or None
+    details_offset : int
+        the position of the episode's record in the manifest's details file
+    last_updated : int
+        the last time the episode object was updated in seconds since the
+        epoch, episodes updated in the same second share one int object
+    tags : tuple
+        the tags of the episode as interned strings
+    guid : str
+        the unique id of the rss item, or None if the feed did not supply one
+    content_hash : str
+        the entry_hash of the rss item the episode was last updated from
+    last_viewed : int
+        when the episode was last opened with view() in seconds since the
+        epoch, 0 if never, used by least recently viewed retention
+    evicted : bool
+        whether retention deleted the file, evicted episodes are skipped
+        when downloading every missing episode
         
     Methods
     -------
     to_json()
-        returns the object.__dict__ for saving to json
+        returns the index fields of the episode for saving to json
+    keys()
+        returns the (kind, value) keys used to index the episode in a Manifest
+    record_key()
+        returns the key identifying the episode's stored records
     update_fp(entry: feedparser entry, number: int)
-        updates the last_updated time, and compares the entry against the saved
-        values, updating them if they have changed
-    download(verbosity: int=1, force: bool=False)
+        compares the entry against the saved values, updating them and the
+        last_updated time if they have changed
+    download(verbosity: int=1, force: bool=False, callback=None, throttle=None)
         downloads the file at url to file_path with varying levels of status 
         printing
     view()
@@ -59,29 +121,97 @@ class Episode:
         prepending the folder to the generated file_path
     """
     
-    def __init__(self, title: str, folder:str, url: str, episode_number: int, published: str, summary: str, tags: list):
+    __slots__ = ('title', 'file_path', 'url', 'downloaded', 'episode_number', 'published',
+                 'last_updated', 'tags', 'guid', 'summary_loader', 'details_offset', '_summary',
+                 'content_hash', 'last_viewed', 'evicted')
+    
+    def __init__(self, title: str, folder:str, url: str, episode_number: int, published, summary: str, tags: list, guid: str=None):
         self.title = title
         self.file_path = folder + clean_path(title.lower().replace('/','-')) + '.mp3'
         self.url = url
         self.downloaded = os.path.exists(self.file_path)
         self.episode_number = episode_number
-        self.published = tuple(published)
-        self.summary = summary
-        self.last_updated = time.localtime()
-        self.tags = tags
+        self.published = to_epoch(published)
+        self.last_updated = timestamp()
+        self.tags = intern_tags(tags)
+        self.guid = guid
+        self.summary_loader = None
+        self.details_offset = None
+        self._summary = summary
+        self.content_hash = None
+        self.last_viewed = 0
+        self.evicted = False
+    
+    @property
+    def summary(self) -> str:
+        if self._summary is None and self.summary_loader is not None:
+            self._summary = self.summary_loader(self)
+        return self._summary
+    
+    @summary.setter
+    def summary(self, summary: str) -> None:
+        self._summary = summary
+    
+    @property
+    def cached_summary(self) -> str:
+        """The summary if it is loaded, without calling summary_loader"""
+        return self._summary
     
     def to_json(self) -> dict:
-        """Returns the object's __dict__
+        """Returns the index fields of the episode
+        
+        The summary is saved separately in the manifest's details file
         
         Returns
         -------
         dict
-            the objects attributes
+            the objects attributes without the summary
+        
+        """
+        return {
+            'title': self.title,
+            'file_path': self.file_path,
+            'url': self.url,
+            'downloaded': self.downloaded,
+            'episode_number': self.episode_number,
+            'published': self.published,
+            'last_updated': self.last_updated,
+            'tags': list(self.tags),
+            'guid': self.guid,
+            'details': self.details_offset,
+            'hash': self.content_hash,
+            'viewed': self.last_viewed,
+            'evicted': self.evicted,
+        }
+    
+    def keys(self) -> list:
+        """Returns the keys used to look the episode up in a Manifest
         
+        Returns
+        -------
+        list
+            (kind, value) tuples for the guid, url and title that are set
+        """
+        keys = []
+        if self.guid is not None:
+            keys.append(('guid', self.guid))
+        if self.url is not None:
+            keys.append(('url', self.url))
+        keys.append(('title', self.title))
+        return keys
+    
+    def record_key(self) -> str:
+        """Returns the key identifying the episode's stored records
+        
+        Returns
+        -------
+        str
+            the first of keys() as 'kind:value'
         """
-        return self.__dict__
+        kind, value = self.keys()[0]
+        return f'{kind}:{value}'
     
-    def update_fp(self, entry, number: int) -> None:
+    def update_fp(self, entry, number: int, content_hash: str=None) -> bool:
         """Updates the object's attributes from an entry
         
         Parameters
@@ -90,28 +220,47 @@ class Episode:
             An entry from a feedparser parsed feed
         number : int
             The number of the episode chronologically
+        content_hash : str, optional
+            The entry_hash of the entry if it was already computed
+        
+        Returns
+        -------
+        bool
+            Whether any of the saved values changed
         """
         
-        self.last_updated = time.localtime()
         self.episode_number = number
-        url = None
-        for link in entry.links:
-            if 'audio' in link['type']:
-                url = link['href']
+        self.content_hash = content_hash or entry_hash(entry)
+        changed = False
+        # Entries are matched on guid, so the publisher may have retitled it
+        if entry.title != self.title:
+            self.title = entry.title
+            changed = True
+        if self.guid is None and entry.get('id', None) is not None:
+            self.guid = entry.get('id', None)
+            changed = True
+        url = audio_url(entry)
         if url is None:
             fprint('No valid audio file', 'rt')
 
         summary = entry.summary
-        published = entry.published_parsed
+        published = to_epoch(entry.published_parsed)
         if url != self.url:
             self.url = url
             self.downloaded = False
+            changed = True
         if summary != self.summary:
             self.summary = summary
+            changed = True
         if published != self.published:
             self.published = published
+            changed = True
+        if changed:
+            self.last_updated = timestamp()
+        return changed
     
-    def download(self, verbosity: int=1, force: bool=False)-> None:
+    @metrics.timed('episode.download')
+    def download(self, verbosity: int=1, force: bool=False, callback=None, throttle=None, host_slots=None)-> None:
         """Downloads the url to file_path
         
         Parameters
@@ -124,19 +273,42 @@ class Episode:
         force : bool, optional
             Whether the function should overwrite the file if it is already 
             present (default is False)
+        callback : callable, optional
+            A progress callback passed to download_file when verbosity is 0,
+            used by the DownloadPool progress display (default is None)
+        throttle : callable, optional
+            Called with the size of each chunk to limit the download rate,
+            see DownloadPolicy.throttle (default is None)
+        host_slots : threading.Semaphore, optional
+            The per host connection limit of a DownloadPool, one slot held
+            by the caller, segmented downloads only add free slots (default
+            is None)
         
         """
         
-        if force or not self.downloaded:
+        index = get_index()
+        if not force and not self.downloaded and index.link_copy(self.url, self.file_path):
+            # Another feed already downloaded the same file
+            metrics.count('episode.linked')
+            self.downloaded = True
+            self.evicted = False
+            if verbosity > 0:
+                fprint(self.title, 'g')
+                fprint("Linked existing copy", 'gt')
+        elif force or not self.downloaded:
             if verbosity == 0:
-                download_file(self.url, self.file_path)
+                size, digest = download_file(self.url, self.file_path, callback, throttle=throttle,
+                                             host_slots=host_slots)
+                self.downloaded = True
             elif verbosity > 0:
                 fprint(self.title, 'g')
                 if self.downloaded:
                     fprint('Overwriting File...', 'gt')
                 fprint('-' * 20, 'gt')
-                download_file(self.url, self.file_path, download_progress)
+                size, digest = download_file(self.url, self.file_path, download_progress, throttle=throttle)
                 self.downloaded = True
+            self.evicted = False
+            index.add(self.file_path, size, digest, self.url)
         else:
             if verbosity > 0:
                 fprint(self.title, 'g')
@@ -159,6 +331,8 @@ class Episode:
             Whether the user has selected to exit the list view
         """
         
+        from simple_term_menu import TerminalMenu
+        self.last_viewed = timestamp()
         actions = ["Back to list", "Download", "Exit"]
         action_menu = TerminalMenu(actions)
         clear()
@@ -167,7 +341,7 @@ class Episode:
         else:
             title_format = 'bt'
         fprint(self.title, title_format)
-        fprint(time.asctime(tuple(self.published)), 'b')
+        fprint(time.asctime(time.gmtime(self.published)), 'b')
         fprint(self.summary, 'g')
         choice = action_menu.show()
     
@@ -175,6 +349,7 @@ class Episode:
             return True
         if choice == 1:
             self.download(2, True)
+            get_index().flush()
             return True
         if choice == 2:
             return False
@@ -194,25 +369,32 @@ class Episode:
         if published is None:
             fprint("Invalid dict: No 'published' key", 'rt')
             return None
+        # Older manifests kept the summary inline, newer ones keep it in
+        # the details file and load it on demand
         summary = source_dict.get('summary', None)
-        if summary is None:
-            fprint("Invalid dict: No 'summary' key", 'rt')
-            return None
         tags = source_dict.get('tags', None)
         if tags is None:
             fprint("Invalid dict: No 'tags' key", 'rt')
             return None
-        return Episode(title, folder, url, episode_number, published, summary, tags)
+        guid = source_dict.get('guid', None)
+        episode = Episode(title, folder, url, episode_number, published, summary, tags, guid)
+        episode.details_offset = source_dict.get('details', None)
+        episode.content_hash = source_dict.get('hash', None)
+        episode.last_viewed = source_dict.get('viewed', 0)
+        episode.evicted = source_dict.get('evicted', False)
+        # Older manifests saved a time tuple
+        episode.last_updated = to_epoch(source_dict.get('last_updated')) or timestamp()
+        return episode
         
     @staticmethod
     def from_fp(entry, folder: str, episode_number: int):
         title = entry.title
-        url = None
-        for link in entry.links:
-            if 'audio' in link['type']:
-                url = link['href']
+        url = audio_url(entry)
         if url is None:
             fprint('No valid audio file', 'rt')
         published = entry.published_parsed
         summary = entry.summary
-        return Episode(title, folder, url, episode_number, published, summary, [])
+        guid = entry.get('id', None)
+        episode = Episode(title, folder, url, episode_number, published, summary, [], guid)
+        episode.content_hash = entry_hash(entry)
+        return episode
@@ -6,6 +6,7 @@
     
 '''
 
+import threading, time
 from colorama import Back, Fore, Style
 
 
@@ -72,3 +73,111 @@ def download_progress(content_remaining, file_size) -> None:
     percentage = progress / file_size
     progress_string = f' {round(progress/1048576, 2)}MB / {round(file_size/1048576, 2)}MB'
     progress_bar(percentage, progress_string, 'Ogt')
+
+def format_size(size: float) -> str:
+    return f'{round(size/1048576, 2)}MB'
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+class MultiProgress:
+    """
+    A multi-line progress display for several downloads running at once
+    
+    The first line is an aggregate summary (episodes finished, bytes, 
+    throughput and ETA) followed by one progress bar per active download.
+    Every method is safe to call from worker threads.
+    
+    Methods
+    -------
+    start(key, label: str)
+        adds a progress bar for a download
+    update(key, content_remaining: int, file_size: int)
+        progress callback compatible with file_utils.download_file
+    finish(key, failed: bool=False)
+        removes the progress bar for a download
+    summary()
+        returns the aggregate summary line
+    """
+    
+    def __init__(self, total: int, refresh: float=0.1):
+        self.total = total
+        self.refresh = refresh
+        self.finished = 0
+        self.failed = 0
+        self.done_bytes = 0
+        self.done_sizes = []
+        self.active = {}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._drawn = 0
+        self._last_draw = 0.0
+    
+    def start(self, key, label: str) -> None:
+        with self._lock:
+            self.active[key] = [label, 0, 0]
+            self._draw(True)
+    
+    def update(self, key, content_remaining: int, file_size: int) -> None:
+        with self._lock:
+            bar = self.active.get(key)
+            if bar is None:
+                return
+            bar[1] = file_size - content_remaining
+            bar[2] = file_size
+            self._draw()
+    
+    def finish(self, key, failed: bool=False) -> None:
+        with self._lock:
+            label, received, file_size = self.active.pop(key, ['', 0, 0])
+            self.finished += 1
+            self.done_bytes += received
+            if failed:
+                self.failed += 1
+            else:
+                self.done_sizes.append(file_size or received)
+            self._draw(True)
+    
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        received = self.done_bytes + sum(bar[1] for bar in self.active.values())
+        rate = received / elapsed
+        line = f'{self.finished}/{self.total} done, {format_size(received)} at {format_size(rate)}/s'
+        if self.failed:
+            line += f', {self.failed} failed'
+        known = self.done_sizes + [bar[2] for bar in self.active.values() if bar[2]]
+        if rate > 0 and known:
+            # Estimate the size of downloads that have not started from the
+            # average of the ones we know about
+            average = sum(known) / len(known)
+            pending = self.total - self.finished - len(self.active)
+            remaining = sum(bar[2] - bar[1] for bar in self.active.values() if bar[2])
+            remaining += pending * average
+            line += f', ETA {format_duration(remaining / rate)}'
+        return line
+    
+    def _draw(self, force: bool=False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_draw < self.refresh:
+            return
+        self._last_draw = now
+        lines = [(self.summary(), 'bt')]
+        for label, received, file_size in self.active.values():
+            percent = received / file_size if file_size else 0
+            bar = '=' * int(percent * 20) + '-' * (20 - int(percent * 20))
+            lines.append((f'{bar} {format_size(received)} / {format_size(file_size)} {label}', 'g'))
+        # Move back over the previous frame and redraw it in place
+        print(LINE_UP * self._drawn, end='')
+        for string, formatting in lines:
+            print(LINE_CLEAR, end='')
+            fprint(string, formatting)
+        for _ in range(self._drawn - len(lines)):
+            print(LINE_CLEAR)
+        print(LINE_UP * max(self._drawn - len(lines), 0), end='')
+        self._drawn = len(lines)
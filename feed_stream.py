@@ -0,0 +1,127 @@
+'''
+    Paul Smith
+
+    An incremental rss parser that reads <item> elements one at a time, so
+    very large feeds can be processed without building the whole document
+    in memory
+
+'''
+
+import xml.etree.ElementTree as ET
+from email.utils import parsedate_to_datetime
+
+ITUNES = '{http://www.itunes.com/dtds/podcast-1.0.dtd}'
+
+
+def parse_date(value: str):
+    '''
+        Parse an RFC 822 date as used by rss into a UTC struct_time
+
+        returns: time.struct_time or None
+
+    '''
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value.strip()).utctimetuple()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class StreamEntry(dict):
+    """
+    A single rss item with the attributes Episode.from_fp and
+    Episode.update_fp read from a feedparser entry
+
+    ...
+
+    Attributes
+    ----------
+    title : str
+    links : list
+        dictionaries with 'href' and 'type' keys for each enclosure
+    summary : str
+    published_parsed : time.struct_time
+    id : str
+        the guid of the item, also available through get('id')
+    """
+
+    __getattr__ = dict.get
+
+
+class FeedStream:
+    """
+    A class to iterate over the items of an rss document incrementally
+
+    ...
+
+    Attributes
+    ----------
+    feed : dict
+        the channel's title, author and updated_parsed, filled in as the
+        elements before the first item are read
+
+    Methods
+    -------
+    entries()
+        yields a StreamEntry for every item, newest first as in the feed,
+        discarding each element once it has been read
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.feed = StreamEntry()
+
+    def _channel(self, element) -> None:
+        tag = element.tag
+        if tag == 'title' and 'title' not in self.feed:
+            self.feed['title'] = (element.text or '').strip()
+        elif tag == ITUNES + 'author' or (tag == 'author' and 'author' not in self.feed):
+            self.feed['author'] = (element.text or '').strip()
+        elif tag in ('lastBuildDate', 'pubDate') and 'updated_parsed' not in self.feed:
+            self.feed['updated_parsed'] = parse_date(element.text)
+
+    @staticmethod
+    def _entry(item) -> StreamEntry:
+        entry = StreamEntry(title='', links=[], summary='', published_parsed=None)
+        for child in item:
+            tag, text = child.tag, (child.text or '').strip()
+            if tag == 'title':
+                entry['title'] = text
+            elif tag == 'guid':
+                entry['id'] = text
+            elif tag == 'enclosure':
+                entry['links'].append({'href': child.get('url'), 'type': child.get('type', '')})
+            elif tag == 'description' or (tag == ITUNES + 'summary' and not entry['summary']):
+                entry['summary'] = text
+            elif tag == 'pubDate':
+                entry['published_parsed'] = parse_date(text)
+        return entry
+
+    def entries(self):
+        depth = 0
+        channel = None
+        in_item = False
+        for event, element in ET.iterparse(self.source, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if element.tag == 'channel':
+                    channel = element
+                elif element.tag == 'item':
+                    in_item = True
+                continue
+            depth -= 1
+            if element.tag == 'item':
+                in_item = False
+                yield self._entry(element)
+                # Drop the finished item so memory stays bounded
+                element.clear()
+                if channel is not None:
+                    channel.remove(element)
+            elif not in_item and depth == 2:
+                # Direct children of <channel> describe the feed itself
+                self._channel(element)
+                if channel is not None and element.tag != 'item':
+                    element.clear()
+        if 'title' not in self.feed:
+            raise ValueError('No rss channel found')
@@ -8,12 +8,172 @@
 
 import os
 import json
-import requests
+import hashlib
+import stat
+import tempfile
+import queue
+import threading
+import time
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-def write_manifest(data: dict, path: str) -> None:
-    with open(path, 'w') as manifest:
-        json.dump(data, manifest, indent=4)
+# Settings for the shared HTTP session
+POOL_SIZE = 10
+TIMEOUT = (10, 60)
+RETRIES = 3
+BACKOFF = 0.5
 
+# Settings for downloads, bytes per network read, chunks held between the
+# reader and the writer and seconds between progress callbacks
+CHUNK_SIZE = 262144
+WRITE_QUEUE = 16
+PROGRESS_INTERVAL = 0.1
+# Files of at least SEGMENT_THRESHOLD bytes are fetched over SEGMENTS
+# connections at once when the server supports byte ranges
+SEGMENTS = 1
+SEGMENT_THRESHOLD = 104857600
+
+_session = None
+_session_lock = threading.Lock()
+
+def configure_session(pool_size: int=None, timeout: float=None, retries: int=None, backoff: float=None) -> None:
+    global POOL_SIZE, TIMEOUT, RETRIES, BACKOFF, _session
+    with _session_lock:
+        if pool_size is not None:
+            POOL_SIZE = pool_size
+        if timeout is not None:
+            TIMEOUT = (min(10, timeout), timeout)
+        if retries is not None:
+            RETRIES = retries
+        if backoff is not None:
+            BACKOFF = backoff
+        # The next get_session call builds a session with the new settings
+        _session = None
+
+def configure_downloads(chunk_size: int=None, write_queue: int=None, progress_interval: float=None,
+                        segments: int=None, segment_threshold: int=None) -> None:
+    global CHUNK_SIZE, WRITE_QUEUE, PROGRESS_INTERVAL, SEGMENTS, SEGMENT_THRESHOLD
+    if chunk_size is not None:
+        CHUNK_SIZE = chunk_size
+    if write_queue is not None:
+        WRITE_QUEUE = write_queue
+    if progress_interval is not None:
+        PROGRESS_INTERVAL = progress_interval
+    if segments is not None:
+        SEGMENTS = segments
+    if segment_threshold is not None:
+        SEGMENT_THRESHOLD = segment_threshold
+
+def get_session():
+    # A single keep-alive session shared by feed fetches and downloads, so
+    # requests to the same host reuse connections instead of repeating the
+    # DNS lookup and TCP/TLS handshake
+    global _session
+    with _session_lock:
+        if _session is None:
+            # requests is slow to import, so load it on first use
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=RETRIES, backoff_factor=BACKOFF,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=('GET', 'HEAD'))
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+# Read once at import, os.umask can only be read by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def file_mode(path: str) -> int:
+    # The permissions of the file being replaced, or the default for a new
+    # file under the process umask
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        return 0o666 & ~_UMASK
+
+@contextmanager
+def atomic_write(path: str, mode: str='w'):
+    # Write to a temporary file and rename it over the target, so a crash
+    # mid-write never leaves a truncated file behind
+    directory = os.path.dirname(path) or '.'
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(handle, mode) as output:
+            # mkstemp creates files readable only by their owner
+            if hasattr(os, 'fchmod'):
+                os.fchmod(output.fileno(), file_mode(path))
+            yield output
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def write_manifest(data: dict, path: str, compact: bool=False) -> None:
+    with atomic_write(path) as manifest:
+        if compact:
+            json.dump(data, manifest, separators=(',', ':'))
+        else:
+            json.dump(data, manifest, indent=4)
+
+
+def write_details(records: list, path: str) -> list:
+    # Writes one json record per line and returns the byte offset of each,
+    # so a single record can be read later without parsing the whole file
+    offsets = []
+    with atomic_write(path, 'wb') as details:
+        for record in records:
+            offsets.append(details.tell())
+            details.write(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+    return offsets
+
+def append_details(records: list, path: str) -> list:
+    # Appends records to a details file written by write_details, returning
+    # their offsets. Superseded records further up are skipped by offset
+    offsets = []
+    with open(path, 'ab') as details:
+        for record in records:
+            offsets.append(details.tell())
+            details.write(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+        details.flush()
+        os.fsync(details.fileno())
+    return offsets
+
+def read_detail(path: str, offset: int, key: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as details:
+        if offset is not None:
+            details.seek(offset)
+            try:
+                record = json.loads(details.readline() or b'{}')
+            except ValueError:
+                # The offset points into the middle of a record
+                record = None
+            if isinstance(record, dict) and record.get('key') == key:
+                return record
+            details.seek(0)
+        # The offset is stale, fall back to scanning for the latest record
+        # with the key, appended records supersede earlier ones
+        found = {}
+        for line in details:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A record cut short by an interrupted append
+                continue
+            if isinstance(record, dict) and record.get('key') == key:
+                found = record
+    return found
         
 def read_manifest(path: str) -> dict:
     if os.path.exists(path):
@@ -24,23 +184,422 @@ def read_manifest(path: str) -> dict:
         
     return manifest_data
 
-def download_file(url: str, filename: str=None, callback=None):
+@metrics.timed('download.file')
+def download_file(url: str, filename: str=None, callback=None, retries: int=3, throttle=None, segments: int=None,
+                  host_slots=None):
+    # segments defaults to the SEGMENTS setting, large files are then split
+    # into byte ranges fetched in parallel when the server allows it.
+    # host_slots is the semaphore limiting connections to the url's host,
+    # one slot held by the caller, segments beyond the first take free slots
     if filename is None:
         filename = url.split('/')[-1]
+    import requests
+    part_path = filename + '.part'
+    state_path = part_path + '.json'
+    segments = SEGMENTS if segments is None else segments
+    if segments > 1:
+        try:
+            remote = probe_ranges(url)
+        except requests.RequestException:
+            remote = None
+        if remote is not None and remote['size'] >= SEGMENT_THRESHOLD:
+            try:
+                return _download_segmented(url, filename, remote, segments, callback, retries, throttle,
+                                           host_slots)
+            except _RangeIgnored:
+                # The server stopped honouring ranges, start over in one stream
+                metrics.count('download.segment_fallbacks')
+                for path in (part_path, state_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+    for attempt in range(retries + 1):
+        try:
+            hasher = _download_part(url, part_path, state_path, callback, throttle)
+            break
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            # The partial file and its state are kept, so the next attempt
+            # resumes where this one stopped
+            if attempt == retries:
+                raise
+            metrics.count('download.retries')
+    # Only move the file into place once it is complete
+    size = os.path.getsize(part_path)
+    os.replace(part_path, filename)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return size, hasher.hexdigest()
+
+def probe_ranges(url: str):
+    '''
+        Ask for the first byte of a url to learn whether the server supports
+        byte ranges and how large the file is
+
+        returns: {'size': int, 'validator': str} or None without range support
+
+    '''
+    headers = {'Accept-Encoding': 'identity', 'Range': 'bytes=0-0'}
+    with get_session().get(url, stream=True, headers=headers, timeout=TIMEOUT) as r:
+        content_range = r.headers.get('Content-Range', '')
+        total = content_range.rpartition('/')[2]
+        if r.status_code != 206 or not total.isdigit():
+            return None
+        # Weak ETags can not be used with If-Range
+        etag = r.headers.get('ETag')
+        if etag and etag.startswith('W/'):
+            etag = None
+        return {'size': int(total), 'validator': etag or r.headers.get('Last-Modified')}
+
+
+class _RangeIgnored(Exception):
+    # A segment request was answered with the whole file
+    pass
+
+
+def _download_segmented(url: str, filename: str, remote: dict, segments: int, callback=None,
+                        retries: int=3, throttle=None, host_slots=None):
+    import requests
+    part_path = filename + '.part'
+    state_path = part_path + '.json'
+    size, validator = remote['size'], remote['validator']
+    state = read_manifest(state_path)
+    # Without a validator a changed file can not be detected, so like the
+    # single stream path nothing is resumed
+    if not (validator is not None and state.get('validator') == validator
+            and state.get('url') == url and state.get('size') == size and 'segments' in state
+            and os.path.exists(part_path)):
+        # Each segment is [first byte, last byte, bytes written and flushed].
+        # 'received' is kept at 0 so the single stream path never resumes
+        # from a segmented part file
+        step = -(-size // segments)
+        state = {'url': url, 'size': size, 'validator': validator, 'received': 0,
+                 'segments': [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]}
+        with open(part_path, 'wb') as f:
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except OSError:
+                    f.truncate(size)
+            else:
+                f.truncate(size)
+    write_manifest(state, state_path)
+    
+    lock = threading.Lock()
+    progress = {'received': sum(segment[2] for segment in state['segments']), 'reported': 0.0}
+    
+    def report(amount: int) -> None:
+        with lock:
+            progress['received'] += amount
+            now = time.monotonic()
+            if callable(callback) and now - progress['reported'] >= PROGRESS_INTERVAL:
+                progress['reported'] = now
+                callback(size - progress['received'], size)
+    
+    def save() -> None:
+        with lock:
+            write_manifest(state, state_path)
+    
+    def fetch(segment: list) -> None:
+        # Segments retry on their own, the others keep downloading
+        for attempt in range(retries + 1):
+            try:
+                return _fetch_segment(url, part_path, segment, validator, throttle, report, save)
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                if attempt == retries:
+                    raise
+                metrics.count('download.segment_retries')
+    
+    pending = [segment for segment in state['segments'] if segment[0] + segment[2] <= segment[1]]
+    if pending:
+        # Never more connections than the session keeps alive, nor more
+        # than the host limit has free
+        connections = min(len(pending), POOL_SIZE)
+        extra = 0
+        if host_slots is not None:
+            while extra < connections - 1 and host_slots.acquire(blocking=False):
+                extra += 1
+            connections = extra + 1
+        try:
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                # list() raises the first segment that failed for good, the
+                # state keeps the finished ones for the next attempt
+                list(executor.map(fetch, pending))
+        finally:
+            for _ in range(extra):
+                host_slots.release()
+    if callable(callback):
+        callback(0, size)
+    
+    # Ranges arrive out of order, so the hash is taken once the file is whole
+    hasher = hash_file(part_path)
+    os.replace(part_path, filename)
+    os.remove(state_path)
+    return size, hasher.hexdigest()
+
+def _fetch_segment(url: str, part_path: str, segment: list, validator: str, throttle, report, save) -> None:
+    start, end, done = segment
+    resumed = done
+    headers = {'Accept-Encoding': 'identity', 'Range': f'bytes={start + done}-{end}'}
+    if validator:
+        headers['If-Range'] = validator
+    with get_session().get(url, stream=True, headers=headers, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise _RangeIgnored(url)
+        with open(part_path, 'r+b') as f:
+            f.seek(start + done)
+            try:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    chunk = chunk[:end + 1 - start - done]
+                    if throttle is not None:
+                        throttle(len(chunk))
+                    f.write(chunk)
+                    done += len(chunk)
+                    report(len(chunk))
+                    # Only flushed bytes are recorded, so a resume never
+                    # skips data still sitting in the buffer
+                    if done - segment[2] >= 4194304:
+                        f.flush()
+                        segment[2] = done
+                        save()
+            finally:
+                f.flush()
+                metrics.count('download.bytes', done - resumed)
+                segment[2] = done
+                save()
+    if start + done <= end:
+        from requests.exceptions import ChunkedEncodingError
+        raise ChunkedEncodingError(
+            f'Incomplete segment: {done} of {end - start + 1} bytes')
+
+def hash_file(path: str, hasher=None):
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            hasher.update(block)
+    return hasher
+
+def _download_part(url: str, part_path: str, state_path: str, callback=None, throttle=None):
+    state = read_manifest(state_path)
+    if state.get('url') == url and os.path.exists(part_path):
+        # A preallocated file is longer than the data written to it, only
+        # the bytes recorded in the state are known to be good
+        received = min(os.path.getsize(part_path), state.get('received', os.path.getsize(part_path)))
+    else:
+        state = {'url': url}
+        received = 0
+    
+    # Weak ETags can not be used with If-Range
+    etag = state.get('etag')
+    if etag and etag.startswith('W/'):
+        etag = None
+    validator = etag or state.get('last_modified')
+    # Compressed transfers would break byte ranges, audio barely compresses
+    headers = {'Accept-Encoding': 'identity'}
+    if received and validator:
+        headers['Range'] = f'bytes={received}-'
+        headers['If-Range'] = validator
+    else:
+        received = 0
+    
     # NOTE the stream=True parameter below
-    with requests.get(url, stream=True) as r:
+    with get_session().get(url, stream=True, headers=headers, timeout=TIMEOUT) as r:
+        # elapsed covers the DNS lookup, connect and wait for the headers
+        metrics.observe('download.ttfb', r.elapsed.total_seconds())
+        if r.status_code == 416 and received == state.get('size'):
+            # The partial file already holds the whole body
+            os.truncate(part_path, received)
+            return hash_file(part_path)
         r.raise_for_status()
-        file_size = int(r.headers.get('Content-Length'))
-        content_remaining = int(file_size)
-        with open(filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192): 
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                #if chunk:
-                content_remaining -= len(chunk)
-                f.write(chunk)
-                if callable(callback):
-                    callback(content_remaining, file_size)
+        if r.status_code == 206:
+            os.truncate(part_path, received)
+            mode = 'r+b'
+            # Only the bytes from an earlier attempt are read back, the rest
+            # is hashed as it arrives
+            hasher = hash_file(part_path)
+        else:
+            # The server ignored the range or the file changed, start over
+            mode = 'wb'
+            received = 0
+            hasher = hashlib.sha256()
+        content_length = r.headers.get('Content-Length')
+        file_size = received + int(content_length) if content_length else None
+        state.update({
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'size': file_size,
+            'received': received,
+        })
+        write_manifest(state, state_path)
+        
+        started = received
+        with open(part_path, mode) as f:
+            f.seek(received)
+            if file_size and hasattr(os, 'posix_fallocate'):
+                # Reserve the space up front so the file is not fragmented
+                # and a full disk fails now rather than halfway through
+                try:
+                    os.posix_fallocate(f.fileno(), received, file_size - received)
+                except OSError:
+                    pass
+            writer = _PartWriter(f, hasher, state, state_path, callback, file_size)
+            writer.start()
+            try:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    if writer.error is not None:
+                        break
+                    if throttle is not None:
+                        throttle(len(chunk))
+                    writer.put(chunk)
+            finally:
+                writer.finish()
+                metrics.count('download.bytes', writer.written - started)
+    
+    received = writer.written
+    state['received'] = received
+    write_manifest(state, state_path)
+    if file_size is not None and received != file_size:
+        from requests.exceptions import ChunkedEncodingError
+        raise ChunkedEncodingError(
+            f'Incomplete download: {received} of {file_size} bytes')
+    return hasher
+
+class _PartWriter(threading.Thread):
+    # Writes, hashes and reports the chunks read by _download_part, so a
+    # slow disk or terminal does not keep the socket waiting. The bounded
+    # queue holds at most WRITE_QUEUE chunks in memory
+    
+    def __init__(self, f, hasher, state: dict, state_path: str, callback, file_size: int):
+        super().__init__(daemon=True)
+        self.f = f
+        self.hasher = hasher
+        self.state = state
+        self.state_path = state_path
+        self.callback = callback if callable(callback) and file_size else None
+        self.file_size = file_size
+        self.written = self.saved = state['received']
+        self.error = None
+        self.queue = queue.Queue(maxsize=WRITE_QUEUE)
+    
+    def put(self, chunk: bytes) -> None:
+        self.queue.put(chunk)
+    
+    def finish(self) -> None:
+        # Waits for every queued chunk to be written, then raises any
+        # error the writer hit
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+    
+    def run(self) -> None:
+        # Write timings are summed locally and reported once per request
+        write_time, stalls = 0.0, 0
+        last_progress = 0.0
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is not None:
+                # Keep draining so the reader never blocks on a full queue
+                continue
+            try:
+                write_start = time.perf_counter()
+                self.f.write(chunk)
+                elapsed = time.perf_counter() - write_start
+                write_time += elapsed
+                if elapsed > metrics.STALL_THRESHOLD:
+                    stalls += 1
+                self.hasher.update(chunk)
+                self.written += len(chunk)
+                # Persist progress every few megabytes for resuming
+                if self.written - self.saved >= 4194304:
+                    self.f.flush()
+                    self.state['received'] = self.saved = self.written
+                    write_manifest(self.state, self.state_path)
+                if self.callback is not None and write_start - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = write_start
+                    self.callback(self.file_size - self.written, self.file_size)
+            except Exception as error:
+                self.error = error
+        try:
+            self.f.flush()
+        except Exception as error:
+            self.error = self.error or error
+        if self.callback is not None and self.error is None:
+            # Always draw the final state of the progress bar
+            self.callback(self.file_size - self.written, self.file_size)
+        metrics.count('download.write_seconds', write_time)
+        metrics.count('download.write_stalls', stalls)
+
+def fetch_feed(url: str, etag: str=None, modified: str=None, cache_path: str=None):
+    headers = {'Accept-Encoding': 'gzip, deflate'}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    with metrics.span('feed.fetch'):
+        r = get_session().get(url, headers=headers, timeout=TIMEOUT)
+    metrics.observe('feed.ttfb', r.elapsed.total_seconds())
+    if r.status_code == 304:
+        # The feed has not changed since the last fetch
+        metrics.count('feed.not_modified')
+        return None, etag, modified
+    r.raise_for_status()
+    body = r.content
+    metrics.count('feed.bytes', len(body))
+    if cache_path is not None:
+        write_feed_cache(body, cache_path)
+    return body, r.headers.get('ETag'), r.headers.get('Last-Modified')
+
+def open_feed(url: str, etag: str=None, modified: str=None, cache_path: str=None):
+    # Like fetch_feed, but streams the body to the cache file in chunks and
+    # returns it opened for reading instead of holding it in memory
+    headers = {'Accept-Encoding': 'gzip, deflate'}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    with metrics.span('feed.fetch'), get_session().get(url, headers=headers, timeout=TIMEOUT, stream=True) as r:
+        metrics.observe('feed.ttfb', r.elapsed.total_seconds())
+        if r.status_code == 304:
+            metrics.count('feed.not_modified')
+            return None, etag, modified
+        r.raise_for_status()
+        if cache_path is not None and os.path.isdir(os.path.dirname(cache_path) or '.'):
+            temp_path = cache_path + '.tmp'
+            with open(temp_path, 'wb') as cache:
+                for chunk in r.iter_content(chunk_size=65536):
+                    cache.write(chunk)
+            os.replace(temp_path, cache_path)
+            stream = open(cache_path, 'rb')
+        else:
+            stream = tempfile.TemporaryFile()
+            for chunk in r.iter_content(chunk_size=65536):
+                stream.write(chunk)
+            stream.seek(0)
+        metrics.count('feed.bytes', stream.seek(0, os.SEEK_END))
+        stream.seek(0)
+        return stream, r.headers.get('ETag'), r.headers.get('Last-Modified')
+
+def write_feed_cache(body: bytes, cache_path: str) -> None:
+    # Replaced whole, a forced update after a 304 parses this copy
+    if os.path.isdir(os.path.dirname(cache_path) or '.'):
+        with atomic_write(cache_path, 'wb') as cache:
+            cache.write(body)
+
+def read_feed_cache(cache_path: str):
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path, 'rb') as cache:
+        return cache.read()
+
+def open_feed_cache(cache_path: str):
+    if not os.path.exists(cache_path):
+        return None
+    return open(cache_path, 'rb')
 
 def clean_path(path: str) -> str:
     cleaned_path = path
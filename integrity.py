@@ -0,0 +1,214 @@
+'''
+    Paul Smith
+
+    A content index of the downloaded audio files in a library, used to
+    hardlink duplicates instead of downloading them again and to verify
+    files against their recorded size and hash
+
+'''
+
+import os, threading
+from concurrent.futures import ThreadPoolExecutor
+from file_utils import read_manifest, write_manifest, hash_file
+
+INDEX_PATH = 'library_index.json'
+_index = None
+_index_lock = threading.Lock()
+
+
+class LibraryIndex:
+    """
+    A class to record the size and sha256 of every downloaded file
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        the path of the json file holding the index
+    files : dict
+        file path -> {'size': int, 'sha256': str, 'url': str}
+
+    Methods
+    -------
+    add(path: str, size: int, digest: str, url: str)
+        records a downloaded file, hardlinking it to an existing copy with
+        the same content, the index is written by the next flush
+    remove(path: str)
+        forgets a file
+    remove_many(paths: list)
+        forgets several files with a single write of the index
+    size(path: str)
+        returns the recorded size of a file, or None
+    usage(folder: str=None)
+        returns the bytes recorded for a feed folder, or for every file
+    disk_usage()
+        returns the bytes used on disk, counting hardlinked copies once
+    find_copy(url: str)
+        returns the path of a complete copy of the url, or None
+    link_copy(url: str, path: str)
+        hardlinks an existing copy of the url to path, returning whether it
+        succeeded
+    verify(full: bool=False, workers: int=8)
+        checks every file in parallel, returning the problems found
+    save()
+        writes the index to disk
+    flush()
+        writes the index if files were added since the last write
+    """
+
+    def __init__(self, path: str=INDEX_PATH):
+        self.path = path
+        self.files = read_manifest(path).get('files', {})
+        self._by_hash = {}
+        self._by_url = {}
+        self._usage = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        for file_path, record in self.files.items():
+            self._by_hash.setdefault(record['sha256'], file_path)
+            if record.get('url'):
+                self._by_url.setdefault(record['url'], file_path)
+            self._account(file_path, record['size'])
+
+    def save(self) -> None:
+        # Written under the lock, so a slower writer can never replace the
+        # file with an older snapshot
+        with self._lock:
+            write_manifest({'files': self.files}, self.path, compact=True)
+            self._dirty = False
+
+    def flush(self) -> None:
+        # Downloads only mark the index dirty, a batch writes it once
+        if self._dirty:
+            self.save()
+
+    def _account(self, path: str, size: int) -> None:
+        # Running totals per feed folder, so usage never stats the files
+        folder = os.path.join(os.path.dirname(path), '')
+        self._usage[folder] = self._usage.get(folder, 0) + size
+
+    def size(self, path: str):
+        record = self.files.get(path)
+        return None if record is None else record['size']
+
+    def usage(self, folder: str=None) -> int:
+        with self._lock:
+            if folder is None:
+                return sum(self._usage.values())
+            return self._usage.get(os.path.join(os.path.dirname(folder), ''), 0)
+
+    def disk_usage(self) -> int:
+        with self._lock:
+            return sum({record['sha256']: record['size'] for record in self.files.values()}.values())
+
+    def _valid(self, path: str) -> bool:
+        record = self.files.get(path)
+        return (record is not None and os.path.exists(path)
+                and os.path.getsize(path) == record['size'])
+
+    def find_copy(self, url: str):
+        with self._lock:
+            path = self._by_url.get(url)
+            return path if path is not None and self._valid(path) else None
+
+    def link_copy(self, url: str, path: str) -> bool:
+        source = self.find_copy(url)
+        if source is None or os.path.abspath(source) == os.path.abspath(path):
+            return False
+        try:
+            os.link(source, path)
+        except OSError:
+            # Different filesystems or no hardlink support, download instead
+            return False
+        record = self.files[source]
+        self.add(path, record['size'], record['sha256'], url)
+        return True
+
+    def add(self, path: str, size: int, digest: str, url: str=None) -> None:
+        with self._lock:
+            existing = self._by_hash.get(digest)
+            if (existing is not None and existing != path and self._valid(existing)
+                    and not os.path.samefile(existing, path)):
+                # Same content under another name, keep one copy on disk
+                try:
+                    temp_path = path + '.link'
+                    os.link(existing, temp_path)
+                    os.replace(temp_path, path)
+                except OSError:
+                    pass
+            previous = self.files.get(path)
+            if previous is not None:
+                self._account(path, -previous['size'])
+            self.files[path] = {'size': size, 'sha256': digest, 'url': url}
+            self._account(path, size)
+            self._by_hash.setdefault(digest, path)
+            if url:
+                self._by_url[url] = path
+            self._dirty = True
+
+    def remove(self, path: str) -> None:
+        self.remove_many([path])
+
+    def remove_many(self, paths: list) -> None:
+        with self._lock:
+            removed = False
+            orphaned = set()
+            for path in paths:
+                record = self.files.pop(path, None)
+                if record is None:
+                    continue
+                removed = True
+                self._account(path, -record['size'])
+                if self._by_hash.get(record['sha256']) == path:
+                    del self._by_hash[record['sha256']]
+                    orphaned.add(record['sha256'])
+                if record.get('url') and self._by_url.get(record['url']) == path:
+                    del self._by_url[record['url']]
+            if orphaned:
+                # Point each hash at another copy in one pass over the index
+                for other, record in self.files.items():
+                    if record['sha256'] in orphaned:
+                        self._by_hash.setdefault(record['sha256'], other)
+        if removed:
+            self.save()
+
+    def _check(self, path: str, record: dict, full: bool):
+        if not os.path.exists(path):
+            return path, 'missing'
+        if os.path.getsize(path) != record['size']:
+            return path, f'size {os.path.getsize(path)} != {record["size"]}'
+        if full and hash_file(path).hexdigest() != record['sha256']:
+            return path, 'hash mismatch'
+        return None
+
+    def verify(self, full: bool=False, workers: int=8) -> list:
+        """Checks every indexed file against its recorded size and hash
+
+        Parameters
+        ----------
+        full : bool, optional
+            Whether to hash every file, otherwise only sizes are compared
+            (default is False)
+        workers : int, optional
+            The number of files checked at once (default is 8)
+
+        Returns
+        -------
+        list
+            (path, problem) tuples for every file that failed
+        """
+        with self._lock:
+            files = list(self.files.items())
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = executor.map(lambda item: self._check(item[0], item[1], full), files)
+            return [result for result in results if result is not None]
+
+
+def get_index(path: str=INDEX_PATH) -> LibraryIndex:
+    # One index shared by every download in the process
+    global _index
+    with _index_lock:
+        if _index is None or _index.path != path:
+            _index = LibraryIndex(path)
+        return _index
@@ -0,0 +1,288 @@
+'''
+    Paul Smith
+
+    A collection of functions for working with every feed saved in the
+    feed manifest at once
+
+'''
+
+import os, time, heapq, itertools
+from concurrent.futures import ThreadPoolExecutor
+from downloader import DownloadPool
+from file_utils import read_manifest, write_manifest
+from fancy_print import fprint
+from manifest import Manifest, parse_feed
+from search import get_search_index
+
+FEED_MANIFEST = 'feed_manifest.json'
+STORE_PATH = 'library.db'
+# When download_new last finished, and how far back its first run looks
+LAST_RUN_PATH = 'last_run.json'
+FIRST_RUN_SINCE = 7 * 86400
+_store = None
+
+
+_feeds_cache = {}
+
+def read_feeds(path: str=FEED_MANIFEST) -> list:
+    if not os.path.exists(path):
+        write_manifest({'feeds': []}, path)
+    # Only parse the feed manifest again when the file has changed
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _feeds_cache.get(path)
+    if cached is None or cached[0] != signature:
+        cached = (signature, read_manifest(path).get('feeds', []))
+        _feeds_cache[path] = cached
+    return list(cached[1])
+
+def open_store(path: str=STORE_PATH):
+    '''
+        Open the SQLite store if the library has been migrated to one
+
+        returns: Store or None
+
+    '''
+    global _store
+    if _store is None and os.path.exists(path):
+        from store import Store
+        _store = Store(path)
+    return _store
+
+def migrate(path: str=FEED_MANIFEST, store_path: str=STORE_PATH) -> int:
+    global _store
+    if _store is None:
+        from store import Store
+        _store = Store(store_path)
+    return _store.migrate(path)
+
+def has_manifest(feed: dict) -> bool:
+    store = open_store()
+    if store is not None:
+        return store.has_feed(feed['folder'])
+    return os.path.exists(feed['folder'] + '.manifest')
+
+def load_manifest(feed: dict, verbosity: int=1, parser=None):
+    # Make a folder for the feed if one does not exist
+    os.makedirs(feed['folder'], exist_ok=True)
+    store = open_store()
+    manifest = None
+    if store is not None:
+        manifest = store.load_manifest(feed['folder'])
+    elif os.path.exists(feed['folder'] + '.manifest'):
+        manifest = Manifest.from_json(feed['folder'])
+    if manifest is None:
+        manifest = Manifest.from_url(feed['url'], verbosity, parser)
+        if manifest is None:
+            return None
+        manifest.folder = feed['folder']
+        manifest.store = store
+        manifest.save()
+        index = get_search_index(create=False)
+        if index is not None:
+            index.add(manifest)
+    return manifest
+
+def refresh_feed(feed: dict, parser=None) -> tuple:
+    '''
+        Update the manifest for a single feed without any terminal output,
+        parser replaces parse_feed for feeds that are not streamed
+
+        returns: (feed, new episodes, error)
+
+    '''
+    try:
+        existing = has_manifest(feed)
+        manifest = load_manifest(feed, verbosity=0, parser=parser)
+        if manifest is None:
+            return feed, [], ValueError('Invalid feed URL')
+        if not existing:
+            # A feed that has never been fetched counts every episode as new
+            return feed, list(manifest.episodes), None
+        return feed, manifest.update(verbosity=0, parser=parser), None
+    except Exception as error:
+        return feed, [], error
+
+def refresh_all(workers: int=8, verbosity: int=1, path: str=FEED_MANIFEST, processes: int=0) -> list:
+    '''
+        Update the manifest of every saved feed using a pool of workers
+
+        With processes above 1 the threads still fetch, merge and save the
+        feeds, but hand the CPU bound feedparser work to a pool of worker
+        processes which send back compact records
+
+        returns: [(feed, new episodes, error)]
+
+    '''
+    feeds = read_feeds(path)
+    # Open the store before starting the workers so they share it
+    open_store()
+    if verbosity > 0:
+        fprint(f'Refreshing {len(feeds)} feeds...', 'g')
+    parsers = None
+    if processes > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Spawned rather than forked, forking while the fetch threads hold
+        # locks can deadlock the children
+        parsers = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        parser = None if parsers is None else lambda body: parsers.submit(parse_feed, body).result()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(lambda feed: refresh_feed(feed, parser), feeds))
+    finally:
+        if parsers is not None:
+            parsers.shutdown()
+
+    if verbosity > 0:
+        total = 0
+        for feed, new_episodes, error in results:
+            if error is not None:
+                fprint(f'{feed["title"]}: {error}', 'rt')
+            elif new_episodes:
+                total += len(new_episodes)
+                fprint(f'{feed["title"]}: {len(new_episodes)} new', 'gt')
+        fprint(f'{total} new episodes across {len(feeds)} feeds', 'bt')
+    return results
+
+def search(text: str, limit: int=20, path: str=FEED_MANIFEST) -> list:
+    '''
+        Search the episodes of every saved feed, building the index from
+        the manifests the first time
+
+        returns: [SearchResult] best match first
+
+    '''
+    index = get_search_index(create=False)
+    if index is None:
+        index = get_search_index()
+        index.rebuild(read_feeds(path), lambda feed: load_manifest(feed, verbosity=0))
+    return index.search(text, limit)
+
+def find_feed(name: str, path: str=FEED_MANIFEST):
+    '''
+        Find a saved feed by its position in the feed manifest or its title
+
+        returns: {'title': str, 'url': str, 'folder': str} or None
+
+    '''
+    feeds = read_feeds(path)
+    if name.isnumeric() and int(name) < len(feeds):
+        return feeds[int(name)]
+    for feed in feeds:
+        if feed['title'].lower() == name.lower():
+            return feed
+    return None
+
+def sync_feed(feed: dict, workers: int=4, per_host: int=2, verbosity: int=0, policy=None,
+              stop=None) -> tuple:
+    '''
+        Update the manifest for a feed then download every missing episode,
+        downloads not yet started are dropped once the stop Event is set
+
+        returns: (feed, new episodes, failed downloads)
+
+    '''
+    existing = has_manifest(feed)
+    manifest = load_manifest(feed, verbosity)
+    if manifest is None:
+        raise ValueError(f'Invalid feed URL: {feed["url"]}')
+    if existing:
+        new_episodes = manifest.update(verbosity=verbosity, interactive=False)
+    else:
+        new_episodes = list(manifest.episodes)
+    failures = manifest.download_episodes(verbosity, workers=workers, per_host=per_host,
+                                          interactive=False, policy=policy, stop=stop)
+    return feed, new_episodes, failures
+
+def download_all(feeds: list, workers: int=4, per_host: int=2, verbosity: int=1, policy=None) -> list:
+    '''
+        Download the missing episodes of several feeds in one pool, so the
+        newest episode of every feed is fetched before any back-catalog
+
+        returns: [(episode, exception)] for failed downloads
+
+    '''
+    manifests = [load_manifest(feed, verbosity) for feed in feeds]
+    manifests = [manifest for manifest in manifests if manifest is not None]
+    episodes = [episode for manifest in manifests for episode in manifest.episodes if not episode.evicted]
+    failures = DownloadPool(workers, per_host, policy).run(episodes, verbosity=verbosity)
+    for manifest in manifests:
+        manifest.save_episodes(manifest.episodes)
+        manifest.flush()
+    return failures
+
+def latest(limit: int=20, since: int=None, path: str=FEED_MANIFEST) -> list:
+    '''
+        The newest episodes across every saved feed, merged from the small
+        .head file of each feed rather than from the full manifests
+
+        returns: [{'folder', 'feed', 'key', 'title', 'published', 'downloaded'}]
+                 newest first, all of them when limit is None, only those
+                 published after since when it is given
+
+    '''
+    store = open_store()
+    if store is not None:
+        return store.latest(limit, since)
+    heads = []
+    for feed in read_feeds(path):
+        head = read_manifest(feed['folder'] + '.head')
+        if not head and os.path.exists(feed['folder'] + '.manifest'):
+            # Manifests saved before heads existed get one on first use
+            manifest = Manifest.from_json(feed['folder'])
+            if manifest is None:
+                continue
+            manifest.save_head()
+            head = read_manifest(feed['folder'] + '.head')
+        heads.append([dict(entry, folder=feed['folder'], feed=feed['title'])
+                      for entry in head.get('episodes', [])])
+    # Every head is sorted newest first, so a k-way merge yields the
+    # timeline without sorting all of it
+    merged = heapq.merge(*heads, key=lambda entry: entry['published'], reverse=True)
+    if since is not None:
+        merged = itertools.takewhile(lambda entry: entry['published'] > since, merged)
+    return list(itertools.islice(merged, limit))
+
+def download_new(workers: int=4, per_host: int=2, verbosity: int=1, policy=None,
+                 since: int=None, path: str=FEED_MANIFEST) -> tuple:
+    '''
+        Download every episode published since the last call in one batch,
+        or since the given epoch. The first run looks back FIRST_RUN_SINCE
+        seconds, later runs only advance once every download succeeded
+
+        returns: (episodes downloaded or attempted, [(episode, exception)])
+
+    '''
+    started = int(time.time())
+    if since is None:
+        since = read_manifest(LAST_RUN_PATH).get('last_run', started - FIRST_RUN_SINCE)
+    entries = latest(None, since, path)
+    by_folder = {}
+    for entry in entries:
+        by_folder.setdefault(entry['folder'], []).append(entry)
+    
+    feeds = {feed['folder']: feed for feed in read_feeds(path)}
+    manifests, episodes = [], []
+    for folder, folder_entries in by_folder.items():
+        manifest = load_manifest(feeds[folder], verbosity=0) if folder in feeds else None
+        if manifest is None:
+            continue
+        if open_store() is None and len(folder_entries) >= Manifest.head_size:
+            # The whole head is new, older new episodes are only in the manifest
+            selected = [episode for episode in manifest.episodes if episode.published > since]
+        else:
+            selected = [manifest.find_record(entry['key']) for entry in folder_entries]
+        # Episodes removed by retention are not fetched again
+        selected = [episode for episode in selected
+                    if episode is not None and not episode.downloaded and not episode.evicted]
+        manifests.append((manifest, selected))
+        episodes.extend(selected)
+    
+    failures = DownloadPool(workers, per_host, policy).run(episodes, verbosity=verbosity) if episodes else []
+    for manifest, selected in manifests:
+        manifest.save_episodes(selected)
+        manifest.flush()
+    if not failures:
+        write_manifest({'last_run': started}, LAST_RUN_PATH)
+    return episodes, failures
@@ -7,12 +7,94 @@
 '''
 import os
 import time
-import feedparser as fp
-from simple_term_menu import TerminalMenu
+import sys
 from fancy_print import fprint, clear, pause
-from file_utils import clean_path, write_manifest, read_manifest
-from manifest import Manifest
+from file_utils import clean_path, write_manifest, fetch_feed
+from library import FEED_MANIFEST, read_feeds, load_manifest, refresh_all, search, latest
 
+# Concurrency limits for downloading episodes
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_PER_HOST = 2
+# Number of feeds fetched at once by 'Refresh all'
+REFRESH_WORKERS = 8
+# Number of episodes in the 'Latest episodes' timeline
+LATEST_SIZE = 50
+
+
+def browse_episodes(heading, entries):
+    '''
+        Show a menu of episodes from any feed and view the chosen ones until
+        the user goes back
+        
+        entries: [(label: str, folder: str, record key: str, preview: str)]
+        
+    '''
+    
+    from simple_term_menu import TerminalMenu
+    
+    choices = [label for label, _, _, _ in entries]
+    choices.append("[q] Back")
+    # The preview pane shows extra detail for the highlighted episode
+    previews = {label: preview for label, _, _, preview in entries}
+    entry_menu = TerminalMenu(choices, preview_command=lambda choice: previews.get(choice, ''))
+    manifests = {}
+    viewing = True
+    while viewing:
+        clear()
+        fprint(heading, 'gt')
+        choice = entry_menu.show()
+        if choice is None or choices[choice] == "[q] Back":
+            viewing = False
+            continue
+        
+        # Load the entry's manifest, keeping it for further selections
+        _, folder, key, _ = entries[choice]
+        if folder not in manifests:
+            feed = next((feed for feed in read_feeds() if feed['folder'] == folder), None)
+            manifests[folder] = None if feed is None else load_manifest(feed, verbosity=0)
+        manifest = manifests[folder]
+        episode = None if manifest is None else manifest.find_record(key)
+        if episode is None:
+            fprint('Episode no longer in the library', 'rt')
+            pause()
+            continue
+        viewing = episode.view()
+        manifest.save_episodes([episode])
+    
+    for manifest in manifests.values():
+        if manifest is not None:
+            manifest.flush()
+    clear()
+
+def search_episodes():
+    '''
+        Search every feed and browse the results
+        
+    '''
+    
+    clear()
+    query = input("Search: ")
+    results = search(query, 50)
+    if not results:
+        fprint('No episodes found', 'rt')
+        pause()
+        clear()
+        return
+    browse_episodes(f'Results for "{query}"',
+                    [(str(result), result.folder, result.key, result.snippet) for result in results])
+
+def latest_episodes():
+    '''
+        Browse the newest episodes across every feed
+        
+    '''
+    
+    entries = []
+    for entry in latest(LATEST_SIZE):
+        date = time.strftime("%Y-%m-%d", time.gmtime(entry['published']))
+        mark = '*' if entry['downloaded'] else ' '
+        entries.append((f'{date} {mark} {entry["feed"]}: {entry["title"]}', entry['folder'], entry['key'], ''))
+    browse_episodes('Latest episodes', entries)
 
 def select_feed():
     '''
@@ -22,23 +104,44 @@ def select_feed():
         
     '''
     
+    from simple_term_menu import TerminalMenu
+    
     # Loop until feed is selected
     selecting_feed = True
     while selecting_feed:
         # Get saved list of feeds, or create one if it does not exist
-        if not os.path.exists('feed_manifest.json'):
-            write_manifest({'feeds': []}, 'feed_manifest.json')
-        feed_manifest = read_manifest('feed_manifest.json')
+        feed_manifest = {'feeds': read_feeds()}
         
         # Create a list of feed titles and actions for the selection menu
         feeds = [feed['title'] for feed in feed_manifest['feeds'] ]
         feeds.append("Add feed")
+        feeds.append("Latest episodes")
+        feeds.append("Search")
+        feeds.append("Refresh all")
         feed_menu = TerminalMenu(feeds)
         
         # Get user selection
         fprint('Available Feeds', 'g')
         feed = feed_menu.show()
         
+        # Handle the 'Latest episodes' action
+        if feeds[feed] == "Latest episodes":
+            latest_episodes()
+            continue
+        
+        # Handle the 'Search' action
+        if feeds[feed] == "Search":
+            search_episodes()
+            continue
+        
+        # Handle the 'Refresh all' action
+        if feeds[feed] == "Refresh all":
+            clear()
+            refresh_all(REFRESH_WORKERS)
+            pause()
+            clear()
+            continue
+        
         # Handle the 'Add feed' action
         if feeds[feed] == "Add feed":
             clear()
@@ -46,8 +149,10 @@ def select_feed():
             feed_to_add = input("Enter feed URL: ")
             # Attempt to parse rss xml from the url
             try:
-                # Parse the rss feed using feedparser
-                feed = fp.parse(feed_to_add)
+                # Fetch through the shared session and parse with feedparser
+                import feedparser as fp
+                body, _, _ = fetch_feed(feed_to_add)
+                feed = fp.parse(body)
                 
                 # Create new feed entry 
                 entry = {}
@@ -57,7 +162,7 @@ def select_feed():
                 
                 # Save the entry to the manifest
                 feed_manifest['feeds'].append(entry)
-                write_manifest(feed_manifest, 'feed_manifest.json')
+                write_manifest(feed_manifest, FEED_MANIFEST)
             except:
                 # Handle error
                 fprint("There was a problem... please try again", 'rt')
@@ -79,6 +184,14 @@ def select_feed():
     
                              
 if __name__ == '__main__':
+    # Run a non-interactive command when any arguments are given
+    if len(sys.argv) > 1:
+        from cli import main
+        raise SystemExit(main())
+    
+    # Heavy modules are only loaded for the interactive menus
+    from simple_term_menu import TerminalMenu
+    
     # Define action menu
     actions = [
         "Download New",
@@ -96,9 +209,11 @@ if __name__ == '__main__':
         feed = select_feed()
     
         # Load the manifest
-        manifest = Manifest.from_json(feed['folder'])
+        manifest = load_manifest(feed)
         if manifest is None:
-            manifest = Manifest.from_url(feed['link'])
+            pause()
+            clear()
+            continue
         
         # Loop until user exits or changes feeds
         active = True
@@ -106,13 +221,14 @@ if __name__ == '__main__':
             # Display Title, date, and action menu
             clear()
             fprint(manifest.title, 'bt')
-            fprint('Last updated: ' + time.asctime(manifest.last_updated), 'b')
+            if manifest.last_updated:
+                fprint('Last updated: ' + time.asctime(manifest.last_updated), 'b')
 
             action = action_menu.show()
            
             # Process user action selection
             if action == 0:
-                manifest.download_episodes()
+                manifest.download_episodes(workers=DOWNLOAD_WORKERS, per_host=DOWNLOAD_PER_HOST)
             elif action == 1:
                 manifest.view_episodes()
             elif action == 2:
@@ -7,22 +7,121 @@
 '''
 
 
-import os, time
-import feedparser as fp
-from simple_term_menu import TerminalMenu
-from file_utils import read_manifest, write_manifest, clean_path
-from fancy_print import fprint, pause, clear
-from episode import Episode
+import os, time, heapq
+import metrics
+from file_utils import read_manifest, write_manifest, write_details, append_details, read_detail, clean_path, fetch_feed, read_feed_cache, write_feed_cache, open_feed, open_feed_cache
+from feed_stream import FeedStream, StreamEntry
+from fancy_print import fprint, pause
+from episode import Episode, audio_url, entry_hash
+from downloader import DownloadPool
+from search import get_search_index
+from integrity import get_index
+
+
+def parse_feed(body: bytes) -> tuple:
+    '''
+        Parse a feed with feedparser into compact records holding only the
+        fields an Episode is built from, so the result is cheap to send
+        back from a worker process
+
+        returns: ({'title': str, 'author': str, 'updated_parsed': tuple},
+                  [StreamEntry] newest first as in the feed)
+
+    '''
+    import feedparser as fp
+    feed_object = fp.parse(body)
+    feed = feed_object.feed
+    updated = feed.get('updated_parsed')
+    info = {
+        'title': feed.get('title', ''),
+        'author': feed.get('author', ''),
+        'updated_parsed': tuple(updated) if updated else None,
+    }
+    entries = []
+    for entry in feed_object.entries:
+        published = entry.get('published_parsed')
+        entries.append(StreamEntry(
+            title=entry.get('title', ''),
+            id=entry.get('id', None),
+            links=[{'href': link.get('href'), 'type': link.get('type', '')}
+                   for link in entry.get('links', []) if 'audio' in link.get('type', '')],
+            summary=entry.get('summary', ''),
+            published_parsed=tuple(published) if published else None))
+    return info, entries
+
+
+class UpdateDiff:
+    """
+    The episodes added, changed and dropped from the feed by an update
+
+    ...
+
+    Attributes
+    ----------
+    new : list
+        episodes appended to the manifest
+    changed : list
+        known episodes whose entry changed
+    removed : list
+        episodes dropped from within the span of dates the feed still
+        covers, they are kept in the manifest so downloaded back catalogs
+        are not forgotten, and older episodes trimmed from the feed are
+        not reported
+    stale_keys : list
+        the previous record_keys of changed episodes whose key changed,
+        e.g. when the enclosure url of an episode without a guid moved
+    rehashed : list
+        unchanged episodes whose saved entry hash was missing or outdated,
+        saved so the next update can skip them
+    """
+
+    __slots__ = ('new', 'changed', 'removed', 'stale_keys', 'rehashed')
+
+    def __init__(self):
+        self.new = []
+        self.changed = []
+        self.removed = []
+        self.stale_keys = []
+        self.rehashed = []
+
+    def __bool__(self) -> bool:
+        return bool(self.new or self.changed or self.removed)
+
+    def __str__(self) -> str:
+        return f'{len(self.new)} new, {len(self.changed)} changed, {len(self.removed)} removed'
 
 
 class Manifest:
+    # Write json manifests without indentation
+    compact = False
+    # Number of newest episodes saved in the .head file for the timeline
+    head_size = 50
+    # Minimum number of seconds between json writes from save_episodes
+    save_interval = 5.0
+    # Parse feeds incrementally with FeedStream instead of feedparser
+    streaming = False
+    # Rewrite the details file once superseded summaries take up this
+    # fraction of the size of the live ones
+    details_compact_ratio = 0.5
+    
     def __init__(self):
         self.title = ''
         self.author = ''
         self.folder = ''
         self.url = ''
-        self.last_updated = ()
+        # None for feeds that carry no channel date
+        self.last_updated = None
+        self.etag = None
+        self.modified = None
         self.episodes = []
+        self.store = None
+        self.last_diff = None
+        self._index = {}
+        self._dirty = False
+        self._details_dirty = False
+        self._details_pending = []
+        self._details_stale = 0
+        self._last_saved = 0.0
         
     @staticmethod
     def from_json(path):
@@ -30,140 +129,406 @@ class Manifest:
         try:
             json_data = read_manifest(path + '.manifest')
         except:
+            json_data = {}
+        if not json_data:
             fprint('No manifest found...', 'rt')
             return None
         manifest.title = json_data['title']
         manifest.author = json_data['author']
-        manifest.last_updated = tuple(json_data['last_updated'])
+        manifest.last_updated = tuple(json_data['last_updated']) if json_data['last_updated'] else None
         manifest.folder = path
         manifest.url = json_data['url']
+        manifest.etag = json_data.get('etag', None)
+        manifest._details_stale = json_data.get('details_stale', 0)
+        manifest.modified = json_data.get('modified', None)
         for number, episode in enumerate(json_data['episodes']):
             episode = Episode.from_dict(episode, path, number)
-            manifest.episodes.append(episode)
+            if episode is not None:
+                if episode.cached_summary is None:
+                    episode.summary_loader = manifest._load_summary
+                else:
+                    # Move summaries out of older manifests on the next save
+                    manifest._details_dirty = True
+                manifest.add_episode(episode)
         return manifest
     
     @staticmethod
-    def from_fp(feed_object):
+    def from_records(info, entries):
+        # Builds a manifest from the output of parse_feed
         manifest = Manifest()
-        manifest.title = feed_object.feed.title
-        manifest.author = feed_object.feed.author
+        manifest.title = info['title']
+        manifest.author = info['author']
         manifest.folder = '../' + clean_path(manifest.title.replace(" ", "_")) + '/'
-        manifest.url = feed_object.href
-        manifest.last_updated = feed_object.feed.updated_parsed
-        for number, episode in enumerate(feed_object.entries[::-1]):
-            episode = Episode.from_fp(episode, manifest.folder, number)
-            manifest.episodes.append(episode)
+        manifest.last_updated = info['updated_parsed']
+        for number, entry in enumerate(reversed(entries)):
+            manifest.add_episode(Episode.from_fp(entry, manifest.folder, number))
+        manifest._details_dirty = True
         return manifest
     
     @staticmethod
-    def from_url(url):
-        fprint("Fetching feed...", 'g')
-        feed_object = fp.parse(url)
-        fprint("Generating manifest...", 'gO')
+    def from_stream(stream):
+        manifest = Manifest()
+        feed_stream = FeedStream(stream)
+        entries = []
+        for entry in feed_stream.entries():
+            if not manifest.folder:
+                manifest.folder = '../' + clean_path(feed_stream.feed['title'].replace(" ", "_")) + '/'
+            entries.append(Episode.from_fp(entry, manifest.folder, 0))
+        manifest.title = feed_stream.feed['title']
+        manifest.author = feed_stream.feed.get('author', '')
+        if not manifest.folder:
+            manifest.folder = '../' + clean_path(manifest.title.replace(" ", "_")) + '/'
+        updated = feed_stream.feed.get('updated_parsed')
+        manifest.last_updated = tuple(updated) if updated else None
+        for number, episode in enumerate(reversed(entries)):
+            episode.episode_number = number
+            manifest.add_episode(episode)
+        manifest._details_dirty = True
+        return manifest
+    
+    @staticmethod
+    @metrics.timed('manifest.from_url')
+    def from_url(url, verbosity=1, parser=None):
+        if verbosity > 0:
+            fprint("Fetching feed...", 'g')
         try:
-            manifest = Manifest.from_fp(feed_object)
+            if Manifest.streaming:
+                stream, etag, modified = open_feed(url)
+                if verbosity > 0:
+                    fprint("Generating manifest...", 'gO')
+                with stream, metrics.span('feed.parse'):
+                    manifest = Manifest.from_stream(stream)
+            else:
+                body, etag, modified = fetch_feed(url)
+                if verbosity > 0:
+                    fprint("Generating manifest...", 'gO')
+                with metrics.span('feed.parse'):
+                    manifest = Manifest.from_records(*(parser or parse_feed)(body))
+                write_feed_cache(body, manifest.folder + '.feed')
         except:
-            fprint('Invalid URL...', 'rtO')
+            if verbosity > 0:
+                fprint('Invalid URL...', 'rtO')
             return None
+        manifest.url = url
+        manifest.etag = etag
+        manifest.modified = modified
         return manifest
         
+    @metrics.timed('manifest.save_to_json')
     def save_to_json(self):
+        # Summaries live in a separate details file that is only rewritten
+        # when they change, the manifest itself is a lightweight index
+        details_path = self.folder + '.details'
+        if self._details_pending and not self._details_dirty:
+            # Only new or changed summaries are appended, the offsets of
+            # the other episodes stay valid
+            records = [{'key': episode.record_key(), 'summary': episode.summary}
+                       for episode in self._details_pending]
+            replaced = [episode.details_offset is not None for episode in self._details_pending]
+            offsets = append_details(records, details_path)
+            size = os.path.getsize(details_path)
+            for episode, offset, end, superseded in zip(self._details_pending, offsets,
+                                                        offsets[1:] + [size], replaced):
+                episode.details_offset = offset
+                if superseded:
+                    # The old record is about as long as the new one
+                    self._details_stale += end - offset
+            self._details_pending = []
+            # Summaries that change on every fetch would grow the file
+            # forever, compact it once the dead records weigh enough
+            if self._details_stale > self.details_compact_ratio * (size - self._details_stale):
+                self._details_dirty = True
+        if self._details_dirty:
+            records = [{'key': episode.record_key(), 'summary': episode.summary}
+                       for episode in self.episodes]
+            offsets = write_details(records, details_path)
+            for episode, offset in zip(self.episodes, offsets):
+                episode.details_offset = offset
+            self._details_dirty = False
+            self._details_pending = []
+            self._details_stale = 0
         json_data = {
             'title': self.title,
             'author': self.author,
             'last_updated': self.last_updated,
             'url': self.url,
+            'etag': self.etag,
+            'modified': self.modified,
+            'details_stale': self._details_stale,
             'episodes': [
                 episode.to_json() for episode in self.episodes
             ]
         }
-        write_manifest(json_data, self.folder + '.manifest')
+        write_manifest(json_data, self.folder + '.manifest', self.compact)
+        self.save_head()
+        self._dirty = False
+        self._last_saved = time.monotonic()
+    
+    def head(self, size=None):
+        # The newest episodes by publishing date, newest first
+        episodes = heapq.nlargest(size or self.head_size, self.episodes, key=lambda episode: episode.published)
+        return [{'key': episode.record_key(), 'title': episode.title, 'published': episode.published,
+                 'downloaded': episode.downloaded} for episode in episodes]
+    
+    def save_head(self):
+        # A small file read by library.latest instead of the whole manifest
+        write_manifest({'title': self.title, 'episodes': self.head()}, self.folder + '.head', compact=True)
+    
+    def _load_summary(self, episode):
+        record = read_detail(self.folder + '.details', episode.details_offset, episode.record_key())
+        return record.get('summary', '')
+    
+    def save(self):
+        # Saves to the SQLite store when the manifest was loaded from one
+        if self.store is not None:
+            self.store.save_manifest(self)
+        else:
+            self.save_to_json()
+    
+    def save_changes(self, episodes, stale_keys=(), rehashed=()):
+        # Saves the feed and the given new or changed episodes, a store only
+        # writes their rows and those of rehashed episodes, and drops the
+        # rows left under stale_keys
+        if self.store is not None:
+            self.store.save_changes(self, list(episodes) + list(rehashed), stale_keys)
+        else:
+            self._details_pending.extend(episodes)
+            self.save_to_json()
+    
+    def save_episodes(self, episodes):
+        # A store updates only the given rows, json rewrites of the whole
+        # manifest are batched to at most one every save_interval seconds
+        if self.store is not None:
+            self.store.save_episodes(self, episodes)
+            return
+        self._dirty = True
+        if time.monotonic() - self._last_saved >= self.save_interval:
+            self.save_to_json()
     
-    def get_episode(self, title):
-        for episode in self.episodes:
-            if episode.title == title:
+    def flush(self):
+        # Writes any changes held back by save_episodes
+        if self._dirty:
+            self.save_to_json()
+    
+    def add_episode(self, episode, position=None):
+        if position is None:
+            self.episodes.append(episode)
+        else:
+            self.episodes.insert(position, episode)
+        self._index_episode(episode)
+    
+    def _index_episode(self, episode):
+        for key in episode.keys():
+            self._index.setdefault(key, episode)
+    
+    def _unindex_episode(self, episode):
+        for key in episode.keys():
+            if self._index.get(key) is episode:
+                del self._index[key]
+    
+    def get_episode(self, key):
+        # Accepts a guid, enclosure url or title
+        for kind in ('guid', 'url', 'title'):
+            episode = self._index.get((kind, key))
+            if episode is not None:
+                return episode
+        return None
+    
+    def find_record(self, key):
+        # Looks an episode up by its record_key, as saved by stores and the
+        # search index
+        kind, _, value = key.partition(':')
+        return self._index.get((kind, value))
+    
+    def find_episode(self, guid=None, url=None, title=None):
+        if guid is not None:
+            episode = self._index.get(('guid', guid))
+            if episode is not None:
+                return episode
+        # Only fall back to the url and title for episodes saved without a
+        # guid, otherwise distinct episodes sharing a title would be merged
+        for key in (('url', url), ('title', title)):
+            episode = self._index.get(key)
+            if episode is not None and (guid is None or episode.guid is None):
                 return episode
         return None
         
-    def update(self, forced=False):
-        feed_object = fp.parse(self.url)
-        if (self.last_updated == feed_object.feed.updated_parsed) and not forced:
-            fprint('Manifest up to date..', 'gt')
+    @metrics.timed('manifest.update')
+    def update(self, forced=False, verbosity=1, interactive=True, parser=None):
+        # parser replaces parse_feed, refresh_all passes one that parses in
+        # a worker process. The streaming parser always runs in process
+        if self.streaming:
+            diff = self._update_streaming(forced)
+        else:
+            diff = self._update_parsed(forced, parser or parse_feed)
+        self.last_diff = diff
+        if diff is None:
+            if verbosity > 0:
+                fprint('Manifest up to date..', 'gt')
+            if verbosity > 0 and interactive:
+                pause()
+            return []
+        # Validators and last_updated are saved even when no entry changed
+        self.save_changes(diff.new + diff.changed, diff.stale_keys, diff.rehashed)
+        index = get_search_index(create=False)
+        if index is not None and (diff.new or diff.changed):
+            index.remove(self.folder, diff.stale_keys)
+            index.add(self, diff.new + diff.changed)
+        if verbosity > 0:
+            fprint(f'Manifest updated: {diff}', 'gt')
+        if verbosity > 0 and interactive:
             pause()
-            return
-        
-        if self.title == feed_object.feed.title:
-            for number, feed_episode in enumerate(feed_object.entries[::-1]):
-                episode = self.get_episode(feed_episode.title)
-                if episode is None:
-                    self.episodes.insert(number, Episode.from_fp(feed_episode, self.folder, number))
-                else:
-                    episode.update_fp(feed_episode, number)
-        fprint('Manifest updated', 'gt')
-        pause()
+        return diff.new
     
-    def view_episodes(self):
-        # Initialize variables
-        page_size = 25
-        current_page = 1
-        last_page = len(self.episodes) // page_size + 1
-    
-        # Loop until a episode is selected
-        selecting_episode = True
-        while selecting_episode:
-            # get start and end index
-            start = (current_page - 1) * page_size
-            end = page_size * current_page
-            if end >= len(self.episodes):
-                end = len(self.episodes) - 1
-                selecting_episode = False
-        
-            # create list of episode titles and commands
-            episodes = []
-            if current_page != 1:
-                episodes.append("[,] Previous page")
-            for episode in self.episodes[start:end]:
-                episodes.append(episode.title)
-         
-            if selecting_episode:
-                episodes.append("[.] Next page")
-        
-            episodes.append("[q] Back")
-            episode_menu = TerminalMenu(episodes)
+    def _apply_entry(self, entry, diff, forced=False):
+        # Matches an entry to its episode, only comparing the fields when the
+        # entry's hash differs from the one saved, and records it in the diff
+        #
+        # returns: (episode, 'new' | 'updated' | 'unchanged'), new episodes
+        # are left for the caller to add
+        content_hash = entry_hash(entry)
+        episode = self.find_episode(entry.get('id', None), audio_url(entry), entry.title)
+        if episode is None:
+            episode = Episode.from_fp(entry, self.folder, len(self.episodes))
+            diff.new.append(episode)
+            return episode, 'new'
+        if episode.content_hash == content_hash and not forced:
+            return episode, 'unchanged'
+        key = episode.record_key()
+        saved_hash = episode.content_hash
+        self._unindex_episode(episode)
+        if episode.update_fp(entry, episode.episode_number, content_hash):
+            diff.changed.append(episode)
+            if episode.record_key() != key:
+                diff.stale_keys.append(key)
+        elif saved_hash != content_hash:
+            # Nothing changed but the hash, e.g. rows migrated from manifests
+            # written before entry hashes
+            diff.rehashed.append(episode)
+        self._index_episode(episode)
+        return episode, 'updated'
+    
+    def _removed(self, seen):
+        # Only gaps inside the window of episodes the feed still publishes
+        # count, back catalogs kept from before the feed was trimmed are not
+        # removed again on every update
+        oldest = min((episode.published for episode in self.episodes if id(episode) in seen), default=None)
+        if oldest is None:
+            return []
+        return [episode for episode in self.episodes
+                if id(episode) not in seen and episode.published >= oldest]
+    
+    def _update_parsed(self, forced, parser):
+        cache_path = self.folder + '.feed'
+        body, self.etag, self.modified = fetch_feed(self.url, self.etag, self.modified, cache_path)
+        if body is None:
+            if not forced:
+                return None
+            # Not modified, a forced update re-parses the cached copy
+            body = read_feed_cache(cache_path)
+            if body is None:
+                body, self.etag, self.modified = fetch_feed(self.url, cache_path=cache_path)
+        with metrics.span('feed.parse'):
+            feed, entries = parser(body)
+        # A 200 answer to a conditional request already means the feed changed
+        validated = self.etag is not None or self.modified is not None
+        # Without a channel date only the validators tell whether the feed changed
+        unchanged = feed['updated_parsed'] is not None and self.last_updated == feed['updated_parsed']
+        if unchanged and not (forced or validated):
+            return None
         
-            # Display menu
-            clear()
-            fprint(f'{self.title}: {current_page}/{last_page}', 'gt')
-            episode = episode_menu.show()
+        diff = UpdateDiff()
+        if self.title == feed['title']:
+            seen = set()
+            # Oldest first, so new episodes are appended in publishing order
+            for entry in reversed(entries):
+                episode, status = self._apply_entry(entry, diff, forced)
+                if status == 'new':
+                    self.add_episode(episode)
+                seen.add(id(episode))
+            diff.removed = self._removed(seen)
+        self.last_updated = feed['updated_parsed'] or self.last_updated
+        return diff
+    
+    def _update_streaming(self, forced):
+        cache_path = self.folder + '.feed'
+        stream, self.etag, self.modified = open_feed(self.url, self.etag, self.modified, cache_path)
+        if stream is None:
+            if not forced:
+                return None
+            stream = open_feed_cache(cache_path)
+            if stream is None:
+                stream, self.etag, self.modified = open_feed(self.url, cache_path=cache_path)
         
-            # Process Selection
+        # Items are newest first, so reading can stop at the first one that
+        # is already known and unchanged unless the update is forced
+        diff = UpdateDiff()
+        seen = set()
+        complete = True
+        with stream, metrics.span('feed.parse'):
+            feed_stream = FeedStream(stream)
+            for entry in feed_stream.entries():
+                if feed_stream.feed.get('title') != self.title:
+                    return diff
+                episode, status = self._apply_entry(entry, diff, forced)
+                if status == 'unchanged':
+                    complete = False
+                    break
+                seen.add(id(episode))
         
-            if episodes[episode] == "[.] Next page":
-                current_page += 1
-            elif episodes[episode] == "[,] Previous page":
-                current_page -= 1
-                selecting_episode = True
-            elif episodes[episode] == "[q] Back":
-                selecting_episode = False
-                clear()
-            else:
-                episode = self.get_episode(episodes[episode])
-                selecting_episode = episode.view()
-                self.save_to_json()
-                clear()
+        # Number the new episodes oldest first after the known ones
+        diff.new.reverse()
+        for episode in diff.new:
+            episode.episode_number = len(self.episodes)
+            self.add_episode(episode)
+        if complete:
+            diff.removed = self._removed(seen)
+        if feed_stream.feed.get('updated_parsed') is not None:
+            self.last_updated = tuple(feed_stream.feed['updated_parsed'])
+        return diff
+    
+    def view_episodes(self):
+        # Imported here so the menu library is only loaded when browsing
+        from browser import EpisodeBrowser
+        EpisodeBrowser(self).run()
     
-    def download_episodes(self, verbosity=1, force=False, episodes=None):
+    def download_episodes(self, verbosity=1, force=False, episodes=None, workers=1, per_host=2, interactive=True, policy=None, stop=None):
         if episodes is None:
-            for episode in self.episodes:
-                episode.download(verbosity=verbosity, force=force)
+            # Files removed by retention stay removed until asked for by name
+            selected = [episode for episode in self.episodes if not episode.evicted]
         else:
+            selected = []
             for episode in episodes:
-                if isinstance(episode, int):
-                    self.episodes[episode].download(verbosity=verbosity, force=force)
+                if isinstance(episode, Episode):
+                    selected.append(episode)
+                elif isinstance(episode, int):
+                    selected.append(self.episodes[episode])
                 elif isinstance(episode, str):
                     if episode.isnumeric():
-                        self.episodes[int(episode)].download(verbosity=verbosity, force=force)
+                        selected.append(self.episodes[int(episode)])
                     else:
-                        self.get_episode(episode).download(verbosity=verbosity, force=force)
-        self.save_to_json()
-        pause()
+                        selected.append(self.get_episode(episode))
+            selected = [episode for episode in selected if episode is not None]
+        
+        # A policy needs the pool's priority queue even with one worker
+        if workers > 1 or policy is not None:
+            failures = DownloadPool(workers, per_host, policy, stop).run(selected, force, verbosity)
+        else:
+            failures = []
+            for episode in selected:
+                try:
+                    episode.download(verbosity=verbosity, force=force)
+                except Exception as error:
+                    failures.append((episode, error))
+                self.save_episodes([episode])
+            get_index().flush()
+        
+        self.save_episodes(selected)
+        self.flush()
+        if failures and verbosity > 0:
+            fprint(f'{len(failures)} episode(s) failed to download:', 'rt')
+            for episode, error in failures:
+                fprint(f'{episode.title}: {error}', 'r')
+        if interactive:
+            pause()
+        return failures
@@ -0,0 +1,126 @@
+'''
+    Paul Smith
+
+    Lightweight timing and counters for the hot paths of a sync, reported
+    as json at the end of a run or as a Prometheus textfile for the node
+    exporter
+
+'''
+
+import functools, json, threading, time
+from contextlib import contextmanager
+
+# Writes slower than this many seconds are counted as write stalls
+STALL_THRESHOLD = 0.05
+
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_started = time.time()
+
+
+def observe(name: str, seconds: float) -> None:
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            _spans[name] = [1, seconds, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = min(stats[2], seconds)
+            stats[3] = max(stats[3], seconds)
+
+def count(name: str, value: float=1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+@contextmanager
+def span(name: str):
+    '''
+        Time the body of a with statement under name, failures are timed
+        too and counted as <name>.errors
+
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        count(name + '.errors')
+        raise
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def timed(name: str):
+    # Decorator form of span
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def reset() -> None:
+    global _started
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _started = time.time()
+
+def report() -> dict:
+    '''
+        Collect every span and counter recorded so far
+
+        returns: {'started': float, 'elapsed': float,
+                  'spans': {name: {'count', 'total', 'mean', 'min', 'max'}},
+                  'counters': {name: number}}
+
+    '''
+    with _lock:
+        spans = {name: {'count': stats[0], 'total': stats[1], 'mean': stats[1] / stats[0],
+                        'min': stats[2], 'max': stats[3]}
+                 for name, stats in sorted(_spans.items())}
+        counters = dict(sorted(_counters.items()))
+    return {'started': _started, 'elapsed': time.time() - _started,
+            'spans': spans, 'counters': counters}
+
+def _write_atomic(text: str, path: str) -> None:
+    # The node exporter may read the file at any moment, never show it a
+    # partial write. Imported here as file_utils imports this module
+    from file_utils import atomic_write
+    with atomic_write(path) as output:
+        output.write(text)
+
+def write_report(path: str) -> None:
+    # '-' prints the report instead of writing a file
+    text = json.dumps(report(), indent=4)
+    if path == '-':
+        print(text)
+    else:
+        _write_atomic(text + '\n', path)
+
+def _metric_name(name: str) -> str:
+    return 'rssdownloader_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+def write_prometheus(path: str) -> None:
+    '''
+        Write the report in the Prometheus text exposition format, spans
+        become <name>_seconds summaries and counters <name>_total
+
+    '''
+    data = report()
+    lines = []
+    for name, stats in data['spans'].items():
+        metric = _metric_name(name) + '_seconds'
+        lines.append(f'# TYPE {metric} summary')
+        lines.append(f'{metric}_count {stats["count"]}')
+        lines.append(f'{metric}_sum {stats["total"]:.6f}')
+        lines.append(f'# TYPE {metric}_max gauge')
+        lines.append(f'{metric}_max {stats["max"]:.6f}')
+    for name, value in data['counters'].items():
+        metric = _metric_name(name) + '_total'
+        lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric} {value}')
+    lines.append('# TYPE rssdownloader_last_run_timestamp_seconds gauge')
+    lines.append(f'rssdownloader_last_run_timestamp_seconds {time.time():.0f}')
+    _write_atomic('\n'.join(lines) + '\n', path)
@@ -0,0 +1,171 @@
+'''
+    Paul Smith
+
+    Retention policies that keep the library within its disk quotas by
+    deleting the files of old or unplayed episodes, using the sizes the
+    library index recorded at download time
+
+'''
+
+import os, time
+from integrity import get_index
+from library import FEED_MANIFEST, read_feeds, has_manifest, load_manifest
+from scheduling import parse_rate
+
+
+def episode_size(episode, index) -> int:
+    size = index.size(episode.file_path)
+    if size is None:
+        # Downloaded before the index existed
+        try:
+            size = os.path.getsize(episode.file_path)
+        except OSError:
+            size = 0
+    return size
+
+
+class RetentionPolicy:
+    """
+    A class describing which downloaded episodes may be deleted
+
+    ...
+
+    Attributes
+    ----------
+    keep_last : int
+        the number of newest downloaded episodes kept for each feed, or None
+    max_bytes : int
+        the most bytes of downloads kept for each feed, or None
+    max_age : float
+        the age in seconds after which downloads are deleted, or None
+    max_total : int
+        the most bytes of downloads kept across the library, or None
+    lru : bool
+        whether size limits delete the least recently viewed episodes first
+        rather than the oldest
+
+    Methods
+    -------
+    for_feed(feed: dict)
+        returns the policy with the overrides of a feed manifest entry
+    select(manifest: Manifest, index: LibraryIndex, now: float=None)
+        returns the downloaded episodes of a manifest the policy deletes
+    order(episodes: list)
+        returns episodes in the order they are deleted to meet a size limit
+    """
+
+    def __init__(self, keep_last: int=None, max_bytes: int=None, max_age: float=None,
+                 max_total: int=None, lru: bool=False):
+        self.keep_last = keep_last
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_total = max_total
+        self.lru = lru
+
+    def for_feed(self, feed: dict):
+        # Feed manifest entries may set 'keep_last', 'max_size' like '5G'
+        # and 'max_age_days'
+        policy = RetentionPolicy(self.keep_last, self.max_bytes, self.max_age, self.max_total, self.lru)
+        if 'keep_last' in feed:
+            policy.keep_last = int(feed['keep_last'])
+        if 'max_size' in feed:
+            policy.max_bytes = int(parse_rate(str(feed['max_size'])))
+        if 'max_age_days' in feed:
+            policy.max_age = float(feed['max_age_days']) * 86400
+        return policy
+
+    def order(self, episodes: list) -> list:
+        if self.lru:
+            return sorted(episodes, key=lambda episode: (episode.last_viewed, episode.published))
+        return sorted(episodes, key=lambda episode: episode.published)
+
+    def select(self, manifest, index, now: float=None) -> list:
+        now = time.time() if now is None else now
+        downloaded = sorted((episode for episode in manifest.episodes if episode.downloaded),
+                            key=lambda episode: episode.published, reverse=True)
+        evicted = set()
+        if self.keep_last is not None:
+            evicted.update(downloaded[self.keep_last:])
+        if self.max_age is not None:
+            evicted.update(episode for episode in downloaded if episode.published < now - self.max_age)
+        if self.max_bytes is not None:
+            kept = [episode for episode in downloaded if episode not in evicted]
+            total = sum(episode_size(episode, index) for episode in kept)
+            for episode in self.order(kept):
+                if total <= self.max_bytes:
+                    break
+                evicted.add(episode)
+                total -= episode_size(episode, index)
+        return [episode for episode in downloaded if episode in evicted]
+
+
+def plan(policy: RetentionPolicy, path: str=FEED_MANIFEST, now: float=None) -> list:
+    '''
+        Work out which downloads every feed's policy and the library wide
+        limit delete, without touching any files
+
+        returns: [(manifest, episode, size)]
+
+    '''
+    index = get_index()
+    selected, kept = [], []
+    for feed in read_feeds(path):
+        # A feed without a manifest has nothing downloaded, and loading it
+        # would fetch the feed and write a new manifest
+        if not has_manifest(feed):
+            continue
+        manifest = load_manifest(feed, verbosity=0)
+        if manifest is None:
+            continue
+        evicted = policy.for_feed(feed).select(manifest, index, now)
+        selected.extend((manifest, episode, episode_size(episode, index)) for episode in evicted)
+        evicted = set(evicted)
+        kept.extend((manifest, episode) for episode in manifest.episodes
+                    if episode.downloaded and episode not in evicted)
+    if policy.max_total is not None:
+        sizes = {episode: episode_size(episode, index) for _, episode in kept}
+        total = sum(sizes.values())
+        manifests = {episode: manifest for manifest, episode in kept}
+        for episode in policy.order(list(sizes)):
+            if total <= policy.max_total:
+                break
+            selected.append((manifests[episode], episode, sizes[episode]))
+            total -= sizes[episode]
+    return selected
+
+def evict(selected: list) -> int:
+    '''
+        Delete the files of planned episodes, dropping them from the library
+        index in one write and saving each manifest once
+
+        returns: the number of bytes freed
+
+    '''
+    index = get_index()
+    by_manifest = {}
+    freed = 0
+    for manifest, episode, size in selected:
+        try:
+            os.remove(episode.file_path)
+        except FileNotFoundError:
+            pass
+        episode.downloaded = False
+        episode.evicted = True
+        freed += size
+        by_manifest.setdefault(id(manifest), (manifest, []))[1].append(episode)
+    index.remove_many([episode.file_path for _, episode, _ in selected])
+    for manifest, episodes in by_manifest.values():
+        manifest.save_episodes(episodes)
+        manifest.flush()
+    return freed
+
+def usage(path: str=FEED_MANIFEST) -> list:
+    '''
+        The bytes of downloads recorded for every feed, from the running
+        totals of the library index
+
+        returns: [(feed, bytes)]
+
+    '''
+    index = get_index()
+    return [(feed, index.usage(feed['folder'])) for feed in read_feeds(path)]
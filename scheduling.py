@@ -0,0 +1,168 @@
+'''
+    Paul Smith
+
+    Bandwidth limiting and scheduling policy for downloads: token bucket
+    rate limits, time windows for back-catalog downloads, and the order
+    episodes are downloaded in
+
+'''
+
+import os, threading, time
+
+
+def parse_rate(rate: str) -> float:
+    '''
+        Parse a rate like '500K' or '2M' into bytes per second
+
+        returns: float
+
+    '''
+    units = {'K': 1024, 'M': 1048576, 'G': 1073741824}
+    rate = rate.strip().upper().rstrip('B/S')
+    if rate and rate[-1] in units:
+        return float(rate[:-1]) * units[rate[-1]]
+    return float(rate)
+
+def parse_window(window: str) -> tuple:
+    '''
+        Parse a window like '22:00-06:00' into minutes after midnight
+
+        returns: (start: int, end: int)
+
+    '''
+    start, end = window.split('-')
+    hours, minutes = start.split(':')
+    start = int(hours) * 60 + int(minutes)
+    hours, minutes = end.split(':')
+    return start, int(hours) * 60 + int(minutes)
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket limiting a stream of bytes to a rate
+
+    ...
+
+    Attributes
+    ----------
+    rate : float
+        the number of bytes allowed per second
+    capacity : float
+        the largest burst of bytes allowed at once
+
+    Methods
+    -------
+    consume(amount: int)
+        blocks until amount bytes may be sent
+    """
+
+    def __init__(self, rate: float, capacity: float=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 65536)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                # Requests larger than the bucket are let through once it is full
+                if self._tokens >= min(amount, self.capacity):
+                    self._tokens -= amount
+                    return
+                wait = (min(amount, self.capacity) - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class DownloadPolicy:
+    """
+    A class describing how fast and when episodes may be downloaded
+
+    ...
+
+    Attributes
+    ----------
+    rate : float
+        the total bytes per second for all downloads, or None for no limit
+    feed_rate : float
+        the bytes per second for the downloads of a single feed, or None
+    windows : list
+        (start, end) minutes after midnight in which back-catalog episodes
+        may be downloaded, an empty list allows them at any time
+
+    Methods
+    -------
+    throttle(folder: str)
+        returns a callable taking a chunk size that blocks to keep the
+        global and per-feed rates
+    in_window(now: float=None)
+        returns whether back-catalog downloads are allowed now
+    wait_for_window(stop: threading.Event=None)
+        blocks until back-catalog downloads are allowed
+    order(episodes: list)
+        returns (priority, episode) tuples, newest episode of each feed first
+    """
+
+    def __init__(self, rate: float=None, feed_rate: float=None, windows: list=None):
+        self.rate = rate
+        self.feed_rate = feed_rate
+        self.windows = windows or []
+        self._bucket = TokenBucket(rate) if rate else None
+        self._feed_buckets = {}
+        self._lock = threading.Lock()
+
+    def throttle(self, folder: str):
+        buckets = []
+        if self._bucket is not None:
+            buckets.append(self._bucket)
+        if self.feed_rate:
+            with self._lock:
+                if folder not in self._feed_buckets:
+                    self._feed_buckets[folder] = TokenBucket(self.feed_rate)
+                buckets.append(self._feed_buckets[folder])
+        if not buckets:
+            return None
+
+        def consume(amount: int) -> None:
+            for bucket in buckets:
+                bucket.consume(amount)
+        return consume
+
+    def in_window(self, now: float=None) -> bool:
+        if not self.windows:
+            return True
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end in self.windows:
+            if start <= end and start <= minute < end:
+                return True
+            # Windows such as 22:00-06:00 wrap around midnight
+            if start > end and (minute >= start or minute < end):
+                return True
+        return False
+
+    def wait_for_window(self, stop: threading.Event=None) -> bool:
+        while not self.in_window():
+            if stop is not None:
+                if stop.wait(30):
+                    return False
+            else:
+                time.sleep(30)
+        return True
+
+    @staticmethod
+    def order(episodes: list) -> list:
+        # Rank the episodes of each feed by publishing date, so the newest
+        # episode of every feed comes before any back-catalog episode
+        feeds = {}
+        for episode in episodes:
+            feeds.setdefault(os.path.dirname(episode.file_path), []).append(episode)
+        ordered = []
+        for feed_episodes in feeds.values():
+            feed_episodes.sort(key=lambda episode: episode.published, reverse=True)
+            ordered.extend(enumerate(feed_episodes))
+        ordered.sort(key=lambda item: item[0])
+        return ordered
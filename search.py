@@ -0,0 +1,240 @@
+'''
+    Paul Smith
+
+    A full text search index over the titles, summaries and tags of every
+    episode in the library, kept in a SQLite FTS5 database and updated as
+    manifests change
+
+'''
+
+import os, re, threading, time
+
+SEARCH_PATH = 'search.db'
+_index = None
+_index_lock = threading.Lock()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL,
+    key TEXT NOT NULL,
+    feed TEXT,
+    title TEXT,
+    summary TEXT,
+    tags TEXT,
+    published INTEGER,
+    UNIQUE (folder, key)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    title, summary, tags, content='documents', content_rowid='id',
+    tokenize='porter unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS documents_insert AFTER INSERT ON documents BEGIN
+    INSERT INTO documents_fts (rowid, title, summary, tags)
+    VALUES (new.id, new.title, new.summary, new.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_delete AFTER DELETE ON documents BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, title, summary, tags)
+    VALUES ('delete', old.id, old.title, old.summary, old.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_update AFTER UPDATE ON documents BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, title, summary, tags)
+    VALUES ('delete', old.id, old.title, old.summary, old.tags);
+    INSERT INTO documents_fts (rowid, title, summary, tags)
+    VALUES (new.id, new.title, new.summary, new.tags);
+END;
+'''
+
+
+def to_query(text: str) -> str:
+    '''
+        Turn free text into an FTS5 query matching every word, the last one
+        as a prefix so results appear while a word is being typed
+
+        returns: str, empty when the text has no words
+
+    '''
+    words = re.findall(r'\w+', text)
+    if not words:
+        return ''
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+class SearchResult:
+    """
+    A single match from SearchIndex.search
+
+    ...
+
+    Attributes
+    ----------
+    folder : str
+        the folder of the feed, as in the feed manifest
+    key : str
+        the record_key of the episode, see Manifest.find_record
+    feed : str
+        the title of the feed
+    title : str
+        the title of the episode
+    published : int
+        the publishing date of the episode in seconds since the epoch (UTC)
+    snippet : str
+        the part of the summary that matched, with matches in [brackets]
+    """
+
+    __slots__ = ('folder', 'key', 'feed', 'title', 'published', 'snippet')
+
+    def __init__(self, folder: str, key: str, feed: str, title: str, published: int, snippet: str):
+        self.folder = folder
+        self.key = key
+        self.feed = feed
+        self.title = title
+        self.published = published
+        self.snippet = snippet
+
+    def __str__(self) -> str:
+        date = time.strftime('%Y-%m-%d', time.gmtime(self.published or 0))
+        return f'{self.feed}: {date} {self.title}'
+
+
+class SearchIndex:
+    """
+    A class to index and search the episodes of every feed
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        the path of the SQLite database holding the index
+
+    Methods
+    -------
+    add(manifest: Manifest, episodes: list=None)
+        indexes the given episodes of a manifest, or all of them
+    remove(folder: str, keys: list)
+        drops the episodes of a feed with the given record_keys
+    remove_feed(folder: str)
+        drops every episode of a feed from the index
+    rebuild(feeds: list, load)
+        replaces the index with the episodes of every feed
+    search(text: str, limit: int=20)
+        returns the best matching episodes as SearchResults
+    count()
+        returns the number of indexed episodes
+    close()
+        closes the database connection
+    """
+
+    def __init__(self, path: str=SEARCH_PATH):
+        # Imported here so sqlite3 is only loaded once search is used
+        import sqlite3
+        self.path = path
+        self._lock = threading.Lock()
+        # Manifests are updated from a thread pool, so the connection is
+        # shared between threads and guarded by the lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def add(self, manifest, episodes: list=None) -> None:
+        if episodes is None:
+            episodes = manifest.episodes
+        rows = [(manifest.folder, episode.record_key(), manifest.title, episode.title,
+                 episode.summary or '', ' '.join(episode.tags), episode.published)
+                for episode in episodes]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT INTO documents (folder, key, feed, title, summary, tags, published) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (folder, key) DO UPDATE SET '
+                'feed = excluded.feed, title = excluded.title, summary = excluded.summary, '
+                'tags = excluded.tags, published = excluded.published',
+                rows)
+
+    def remove(self, folder: str, keys: list) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM documents WHERE folder = ? AND key = ?',
+                                         [(folder, key) for key in keys])
+
+    def remove_feed(self, folder: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM documents WHERE folder = ?', (folder,))
+
+    def rebuild(self, feeds: list, load) -> int:
+        """Replaces the index with the episodes of every feed
+
+        Parameters
+        ----------
+        feeds : list
+            The feeds from the feed manifest
+        load : callable
+            Takes a feed and returns its Manifest or None, see
+            library.load_manifest
+
+        Returns
+        -------
+        int
+            The number of episodes indexed
+        """
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM documents')
+        for feed in feeds:
+            manifest = load(feed)
+            if manifest is not None:
+                self.add(manifest)
+        with self._lock, self._connection:
+            self._connection.execute("INSERT INTO documents_fts (documents_fts) VALUES ('optimize')")
+        return self.count()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def search(self, text: str, limit: int=20) -> list:
+        """Returns the episodes best matching the text
+
+        Parameters
+        ----------
+        text : str
+            Words to look for in titles, summaries and tags
+        limit : int, optional
+            The most results returned (default is 20)
+
+        Returns
+        -------
+        list
+            SearchResults ranked by bm25, title matches weigh the most
+        """
+        query = to_query(text)
+        if not query:
+            return []
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT d.folder, d.key, d.feed, d.title, d.published, "
+                "snippet(documents_fts, 1, '[', ']', '...', 12) "
+                'FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid '
+                'WHERE documents_fts MATCH ? ORDER BY bm25(documents_fts, 10.0, 1.0, 5.0) LIMIT ?',
+                (query, limit)).fetchall()
+        return [SearchResult(*row) for row in rows]
+
+
+def get_search_index(path: str=SEARCH_PATH, create: bool=True):
+    '''
+        Get the search index shared by the process. With create=False a
+        missing index is not started, so libraries that never search do
+        not pay for indexing
+
+        returns: SearchIndex or None
+
+    '''
+    global _index
+    with _index_lock:
+        if _index is None or _index.path != path:
+            if not create and not os.path.exists(path):
+                return None
+            _index = SearchIndex(path)
+        return _index
@@ -0,0 +1,278 @@
+'''
+    Paul Smith
+
+    A SQLite backed store for feeds and episodes, used in place of the json
+    manifests once a library has been migrated
+
+'''
+
+import json, os, sqlite3, threading
+from episode import Episode, timestamp
+from file_utils import read_manifest
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS feeds (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    author TEXT,
+    url TEXT NOT NULL,
+    last_updated TEXT,
+    etag TEXT,
+    modified TEXT
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    id INTEGER PRIMARY KEY,
+    feed_id INTEGER NOT NULL REFERENCES feeds(id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    guid TEXT,
+    title TEXT NOT NULL,
+    url TEXT,
+    episode_number INTEGER NOT NULL,
+    published TEXT,
+    published_at INTEGER,
+    downloaded INTEGER NOT NULL DEFAULT 0,
+    summary TEXT,
+    tags TEXT,
+    content_hash TEXT,
+    last_viewed INTEGER NOT NULL DEFAULT 0,
+    evicted INTEGER NOT NULL DEFAULT 0,
+    last_updated INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (feed_id, key)
+);
+CREATE INDEX IF NOT EXISTS episodes_feed ON episodes (feed_id, episode_number);
+CREATE INDEX IF NOT EXISTS episodes_guid ON episodes (guid);
+CREATE INDEX IF NOT EXISTS episodes_published ON episodes (published_at);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+
+class Store:
+    """
+    A class to save and load manifests in a SQLite database
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        the path of the database file
+
+    Methods
+    -------
+    save_manifest(manifest: Manifest)
+        writes the feed and all of its episodes in a single transaction
+    save_changes(manifest: Manifest, episodes: list, stale_keys: list=())
+        writes the feed and only the given new or changed episodes,
+        deleting the rows under their previous keys
+    save_episode(manifest: Manifest, episode: Episode)
+        updates the row of a single episode
+    save_episodes(manifest: Manifest, episodes: list)
+        updates the rows of several episodes in one transaction
+    has_feed(folder: str)
+        returns whether a manifest is saved for a feed folder
+    latest(limit: int=None, since: int=None)
+        returns the newest episodes across every feed
+    load_manifest(folder: str)
+        returns the Manifest saved for a feed folder, or None
+    migrate(feed_manifest: str)
+        imports the json manifest of every saved feed, once
+    close()
+        closes the database connection
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # Feeds are refreshed from a thread pool, so the connection is shared
+        # between threads and guarded by the lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA foreign_keys=ON')
+        self._connection.executescript(SCHEMA)
+        # Columns added after the first release are added to older databases
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(episodes)')]
+        for column, definition in (('content_hash', 'TEXT'),
+                                   ('last_viewed', 'INTEGER NOT NULL DEFAULT 0'),
+                                   ('evicted', 'INTEGER NOT NULL DEFAULT 0'),
+                                   ('last_updated', 'INTEGER NOT NULL DEFAULT 0')):
+            if column not in columns:
+                self._connection.execute(f'ALTER TABLE episodes ADD COLUMN {column} {definition}')
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _feed_id(self, folder: str):
+        row = self._connection.execute('SELECT id FROM feeds WHERE folder = ?', (folder,)).fetchone()
+        return None if row is None else row[0]
+
+    def _episode_row(self, feed_id: int, episode) -> tuple:
+        # Summaries that were never loaded are passed as None and left as
+        # they are in the database
+        return (feed_id, episode.record_key(), episode.guid, episode.title, episode.url,
+                episode.episode_number, json.dumps(episode.published),
+                episode.published, int(episode.downloaded),
+                episode.cached_summary, json.dumps(episode.tags), episode.content_hash,
+                episode.last_viewed, int(episode.evicted), episode.last_updated)
+
+    def _save_feed(self, manifest) -> int:
+        self._connection.execute(
+            'INSERT INTO feeds (folder, title, author, url, last_updated, etag, modified) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (folder) DO UPDATE SET '
+            'title = excluded.title, author = excluded.author, url = excluded.url, '
+            'last_updated = excluded.last_updated, etag = excluded.etag, '
+            'modified = excluded.modified',
+            (manifest.folder, manifest.title, manifest.author, manifest.url,
+             json.dumps(manifest.last_updated), manifest.etag, manifest.modified))
+        return self._feed_id(manifest.folder)
+
+    def _upsert_episodes(self, rows: list) -> None:
+        self._connection.executemany(
+            'INSERT INTO episodes (feed_id, key, guid, title, url, episode_number, '
+            'published, published_at, downloaded, summary, tags, content_hash, last_viewed, evicted, '
+            'last_updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (feed_id, key) DO UPDATE SET '
+            'guid = excluded.guid, title = excluded.title, url = excluded.url, '
+            'episode_number = excluded.episode_number, published = excluded.published, '
+            'published_at = excluded.published_at, downloaded = excluded.downloaded, '
+            'summary = COALESCE(excluded.summary, episodes.summary), tags = excluded.tags, '
+            'content_hash = excluded.content_hash, last_viewed = excluded.last_viewed, '
+            'evicted = excluded.evicted, last_updated = excluded.last_updated',
+            rows)
+
+    def save_manifest(self, manifest) -> None:
+        with self._lock, self._connection:
+            feed_id = self._save_feed(manifest)
+            rows = [self._episode_row(feed_id, episode) for episode in manifest.episodes]
+            keys = {row[1] for row in rows}
+            stale = [(feed_id, key) for key, in self._connection.execute(
+                'SELECT key FROM episodes WHERE feed_id = ?', (feed_id,)) if key not in keys]
+            self._connection.executemany('DELETE FROM episodes WHERE feed_id = ? AND key = ?', stale)
+            self._upsert_episodes(rows)
+
+    def save_changes(self, manifest, episodes: list, stale_keys: list=()) -> None:
+        with self._lock, self._connection:
+            feed_id = self._save_feed(manifest)
+            # Rows of episodes whose record_key changed go before the upsert,
+            # otherwise the next load returns the episode twice
+            self._connection.executemany('DELETE FROM episodes WHERE feed_id = ? AND key = ?',
+                                         [(feed_id, key) for key in stale_keys])
+            self._upsert_episodes([self._episode_row(feed_id, episode) for episode in episodes])
+
+    def save_episode(self, manifest, episode) -> None:
+        self.save_episodes(manifest, [episode])
+
+    def save_episodes(self, manifest, episodes: list) -> None:
+        with self._lock, self._connection:
+            feed_id = self._feed_id(manifest.folder)
+            if feed_id is None:
+                return
+            rows = [self._episode_row(feed_id, episode) for episode in episodes]
+            self._connection.executemany(
+                'UPDATE episodes SET guid = ?, title = ?, url = ?, episode_number = ?, '
+                'published = ?, published_at = ?, downloaded = ?, '
+                'summary = COALESCE(?, summary), tags = ?, content_hash = ?, last_viewed = ?, '
+                'evicted = ?, last_updated = ? WHERE feed_id = ? AND key = ?',
+                [row[2:] + row[:2] for row in rows])
+
+    def latest(self, limit: int=None, since: int=None) -> list:
+        # Served by the published_at index, newest first, in the same form
+        # as library.latest
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT f.folder, f.title, e.key, e.title, e.published_at, e.downloaded '
+                'FROM episodes e JOIN feeds f ON f.id = e.feed_id WHERE e.published_at > ? '
+                'ORDER BY e.published_at DESC LIMIT ?',
+                (-1 if since is None else since, -1 if limit is None else limit)).fetchall()
+        return [{'folder': folder, 'feed': feed, 'key': key, 'title': title,
+                 'published': published, 'downloaded': bool(downloaded)}
+                for folder, feed, key, title, published, downloaded in rows]
+
+    def has_feed(self, folder: str) -> bool:
+        with self._lock:
+            return self._feed_id(folder) is not None
+
+    def load_manifest(self, folder: str):
+        # Imported here to avoid a circular import with manifest.py
+        from manifest import Manifest
+        with self._lock:
+            feed = self._connection.execute(
+                'SELECT id, title, author, url, last_updated, etag, modified FROM feeds '
+                'WHERE folder = ?', (folder,)).fetchone()
+            if feed is None:
+                return None
+            # Summaries are left out and loaded when an episode is viewed
+            rows = self._connection.execute(
+                'SELECT title, url, episode_number, published, tags, guid, content_hash, '
+                'last_viewed, evicted, last_updated '
+                'FROM episodes WHERE feed_id = ? ORDER BY episode_number', (feed[0],)).fetchall()
+        manifest = Manifest()
+        manifest.title, manifest.author, manifest.url = feed[1:4]
+        updated = json.loads(feed[4])
+        manifest.last_updated = tuple(updated) if updated else None
+        manifest.etag, manifest.modified = feed[5:7]
+        manifest.folder = folder
+        manifest.store = self
+        for title, url, number, published, tags, guid, content_hash, last_viewed, evicted, updated in rows:
+            episode = Episode(title, folder, url, number, json.loads(published),
+                              None, json.loads(tags), guid)
+            episode.content_hash = content_hash
+            episode.last_viewed = last_viewed
+            episode.evicted = bool(evicted)
+            # Rows written before the column existed hold 0
+            episode.last_updated = updated or timestamp()
+            episode.summary_loader = lambda episode, feed_id=feed[0]: self._load_summary(feed_id, episode)
+            manifest.add_episode(episode)
+        return manifest
+
+    def _load_summary(self, feed_id: int, episode) -> str:
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT summary FROM episodes WHERE feed_id = ? AND key = ?',
+                (feed_id, episode.record_key())).fetchone()
+        return '' if row is None or row[0] is None else row[0]
+
+    def migrate(self, feed_manifest: str) -> int:
+        """Imports the json manifest of every saved feed into the store
+
+        Only runs once per database, later calls return without reading
+        any manifests
+
+        Parameters
+        ----------
+        feed_manifest : str
+            The path of the feed manifest listing the saved feeds
+
+        Returns
+        -------
+        int
+            The number of feed manifests imported
+        """
+        # Imported here to avoid a circular import with manifest.py
+        from manifest import Manifest
+        with self._lock:
+            done = self._connection.execute(
+                "SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+        if done is not None:
+            return 0
+        imported = 0
+        for feed in read_manifest(feed_manifest).get('feeds', []):
+            if not os.path.exists(feed['folder'] + '.manifest'):
+                continue
+            manifest = Manifest.from_json(feed['folder'])
+            if manifest is not None:
+                # Load the lazy summaries so they are copied into the store
+                for episode in manifest.episodes:
+                    episode.summary
+                self.save_manifest(manifest)
+                imported += 1
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)",
+                (feed_manifest,))
+        return imported